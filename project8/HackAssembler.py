@@ -0,0 +1,281 @@
+import argparse
+import dataclasses
+import sys
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from hackulator import encode_instruction, init_symbol_table, parse_instruction
+
+
+@dataclasses.dataclass
+class Assembled:
+    """
+    Machine code for a Hack program, plus what a debugger needs to map
+    it back to the source.
+    """
+    words: array
+    labels: Dict[str, int]
+    variables: Dict[str, int]
+    source_lines: List[int]
+
+
+def assemble(lines: Sequence[str]) -> Assembled:
+    """
+    Translate Hack assembly into 16-bit machine words.
+
+    The first pass strips comments and records labels. The second pass
+    encodes each distinct instruction text once; generated code repeats
+    the same handful of instructions (@SP, AM=M-1, ...) over and over, so
+    most lines are a dict lookup.
+
+    Args:
+        lines: lines of Hack assembly
+    Returns:
+        Assembled program; source_lines[pc] is the index of the line pc came from
+    """
+    symbol_table = init_symbol_table()
+    labels: Dict[str, int] = {}
+    variables: Dict[str, int] = {}
+
+    # First pass: add labels to symbol table
+
+    commands: List[str] = []
+    source_lines: List[int] = []
+
+    for line_number, line in enumerate(lines):
+        command = line.split("//", 1)[0].strip()
+        if not command:
+            continue
+
+        if command[0] == "(":
+            parsed = parse_instruction(command)
+            assert parsed is not None and parsed[0] == "L", f"{line_number}: {line}"
+            labels[parsed[1]] = len(commands)
+        else:
+            commands.append(command)
+            source_lines.append(line_number)
+
+    symbol_table.update(labels)
+
+    # Second pass: allocate variables in order of appearance and encode
+
+    idx_next_symbol = 16
+    encoded: Dict[str, int] = {}
+    words = array("H", bytes(2 * len(commands)))
+
+    for pc, command in enumerate(commands):
+        word = encoded.get(command)
+
+        if word is None:
+            parsed = parse_instruction(command)
+            assert parsed is not None
+
+            if parsed[0] == "A" and isinstance(parsed[1], str):
+                addr = symbol_table.get(parsed[1])
+                if addr is None:
+                    addr = symbol_table[parsed[1]] = variables[parsed[1]] = idx_next_symbol
+                    idx_next_symbol += 1
+                parsed = ("A", addr, "")
+
+            try:
+                word = encoded[command] = encode_instruction(parsed)
+            except ValueError as exc:
+                raise ValueError(f"{source_lines[pc]}: {lines[source_lines[pc]]}: {exc}") from None
+
+        words[pc] = word
+
+    return Assembled(words, labels, variables, source_lines)
+
+
+# A chunk of assembly compiled by MachineCodeWriter: its words, with 0 in
+# place of symbols, then (offset, symbol) for those A-instructions and
+# (offset, name) for the labels
+_Chunk = Tuple[array, Tuple[Tuple[int, str], ...], Tuple[Tuple[int, str], ...]]
+
+
+class MachineCodeWriter:
+    """
+    Assembles a program handed over one chunk of assembly at a time,
+    straight into an array of machine words. Jumps to labels and
+    variables go in a fixup table and are filled in by finish, so the
+    assembly text is never kept or parsed twice.
+
+    Each distinct chunk is compiled once. A chunk can use placeholder
+    in its symbols, to be replaced by the label passed to write; that
+    way numbered templates compile once too.
+    """
+
+    def __init__(self, capacity: int = 1 << 12, placeholder: str = "\0"):
+        self.words = array("H", bytes(2 * max(capacity, 1)))
+        self.size = 0
+        self.labels: Dict[str, int] = {}
+        self.fixups: List[Tuple[int, str]] = []
+        self.placeholder = placeholder
+        self.symbol_table = init_symbol_table()
+        self.compiled: Dict[str, _Chunk] = {}
+
+    def compile(self, program: str) -> _Chunk:
+        words = array("H")
+        refs = []
+        labels = []
+
+        for line in program.splitlines():
+            command = line.split("//", 1)[0].strip()
+            if not command:
+                continue
+
+            if command[0] == "(":
+                labels.append((len(words), command[1:-1]))
+                continue
+
+            parsed = parse_instruction(command)
+            assert parsed is not None
+            if parsed[0] == "A" and isinstance(parsed[1], str):
+                addr = self.symbol_table.get(parsed[1])
+                if addr is None:
+                    refs.append((len(words), parsed[1]))
+                    addr = 0
+                parsed = ("A", addr, "")
+
+            try:
+                words.append(encode_instruction(parsed))
+            except ValueError as exc:
+                raise ValueError(f"{line}: {exc}") from None
+
+        return words, tuple(refs), tuple(labels)
+
+    def write(self, program: str, label: Optional[str] = None):
+        """
+        Append the machine code for a chunk of assembly.
+
+        Args:
+            label: replaces placeholder in the chunk's symbols
+        """
+        chunk = self.compiled.get(program)
+        if chunk is None:
+            chunk = self.compiled[program] = self.compile(program)
+        words, refs, labels = chunk
+
+        pc = self.size
+        end = pc + len(words)
+        while end > len(self.words):
+            self.words.frombytes(bytes(2 * len(self.words)))
+        self.words[pc:end] = words
+        self.size = end
+
+        placeholder = self.placeholder
+        for offset, name in labels:
+            if label is not None:
+                name = name.replace(placeholder, label)
+            self.labels[name] = pc + offset
+        for offset, symbol in refs:
+            if label is not None:
+                symbol = symbol.replace(placeholder, label)
+            self.fixups.append((pc + offset, symbol))
+
+    def finish(self) -> Assembled:
+        """
+        Resolve the fixups, allocating variables from 16 in order of
+        appearance like assemble does. There are no source lines.
+        """
+        del self.words[self.size:]
+        variables: Dict[str, int] = {}
+        idx_next_symbol = 16
+
+        for pc, symbol in self.fixups:
+            addr = self.labels.get(symbol)
+            if addr is None:
+                addr = variables.get(symbol)
+                if addr is None:
+                    addr = variables[symbol] = idx_next_symbol
+                    idx_next_symbol += 1
+            if addr >= 0x8000:
+                raise ValueError(f"Address {addr} of {symbol} does not fit in an A-instruction")
+            self.words[pc] = addr
+
+        return Assembled(self.words, self.labels, variables, [])
+
+
+def format_hack(words: Sequence[int]) -> str:
+    """
+    One 16-character binary string per line, as the CPU emulator expects.
+    """
+    return "".join([f"{word:016b}\n" for word in words])
+
+
+def pack_words(words: Sequence[int]) -> bytes:
+    """
+    Machine words as little-endian uint16, two bytes per instruction.
+    """
+    packed = array("H", words)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_words(data: bytes) -> array:
+    words = array("H", data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+def format_symbols(assembled: Assembled) -> str:
+    """
+    User-defined symbols, one "kind name address" per line: labels are
+    ROM addresses and variables are RAM addresses.
+    """
+    out_lines = [f"label {name} {addr}" for name, addr in assembled.labels.items()]
+    out_lines += [f"variable {name} {addr}" for name, addr in assembled.variables.items()]
+    return "".join(line + "\n" for line in out_lines)
+
+
+def format_source_map(assembled: Assembled) -> str:
+    """
+    Line pc + 1 holds the 1-based .asm line number of instruction pc.
+    """
+    return "".join([f"{line + 1}\n" for line in assembled.source_lines])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Assemble a Hack .asm file into .hack machine code."
+    )
+    parser.add_argument(
+        "input_file",
+        help="Hack .asm file"
+    )
+    parser.add_argument(
+        "output_file",
+        nargs="?",
+        help="Optional output .hack file path"
+    )
+    parser.add_argument(
+        "--sym",
+        action="store_true",
+        help="Also write labels and variables to a .sym file"
+    )
+    parser.add_argument(
+        "--map",
+        action="store_true",
+        help="Also write the .asm line of each instruction to a .map file"
+    )
+    args = parser.parse_args()
+
+    input_file = Path(args.input_file)
+    output_file = Path(args.output_file) if args.output_file else input_file.with_suffix(".hack")
+
+    with open(input_file) as fh:
+        assembled = assemble(fh.read().splitlines())
+
+    with open(output_file, "w") as fh:
+        fh.write(format_hack(assembled.words))
+
+    if args.sym:
+        with open(output_file.with_suffix(".sym"), "w") as fh:
+            fh.write(format_symbols(assembled))
+
+    if args.map:
+        with open(output_file.with_suffix(".map"), "w") as fh:
+            fh.write(format_source_map(assembled))
@@ -1,11 +1,15 @@
 import argparse
-from functools import wraps
+import io
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, wraps
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+from typing import Callable, Dict, Iterator, List, Optional, TextIO, Tuple, TypeVar
 
-
-def parsing_error(line_number: int, line: str):
-    raise ValueError((f"No idea how to parse this shit:\n" f"{line_number}: {line}"))
+from HackAssembler import Assembled, MachineCodeWriter, format_hack, pack_words
+from peephole import optimize_program
+from translation_cache import TranslationCache
+from vm_ir import PassManager, VMCommand, parse_vm, parsing_error
+from vm_passes import DeadFunctionElimination, FrameElision, Inliner, register_optimizations
 
 SEGMENT_VM_TO_HACK = {
     "temp": "5",
@@ -142,9 +146,56 @@ def write_sub():
     """
     return program
 
+# Constants the ALU can make without loading them into A
+CONSTANT_COMPS = {0: "0", 1: "1", 0xFFFF: "-1"}
+
 @strip
 def write_push(cmd: str, segment: str, num_str: str, namespace: str) -> str:
-    # Set D to the value we want to push onto the stack.
+    num = int(num_str) & 0xFFFF
+    comment = f"{cmd} {segment} {num}"
+
+    if segment == "constant" and num in CONSTANT_COMPS:
+        # Write the constant straight into the new top of the stack
+        program = f"""
+            @SP // {comment}
+            M=M+1
+            A=M-1
+            M={CONSTANT_COMPS[num]}
+        """
+        return program
+
+    program = write_load_d(segment, num_str, namespace, comment)
+    program += "\n" + write_push_d()
+    return program
+
+@strip
+def write_constant_d(num: int, comment: str = "") -> str:
+    """
+    Set D to a 16-bit constant. A-instructions only hold 15 bits, so
+    larger ones are loaded complemented.
+    """
+    comment = f" // {comment}" if comment else ""
+
+    if num in CONSTANT_COMPS:
+        program = f"D={CONSTANT_COMPS[num]}{comment}"
+    elif num < 0x8000:
+        program = f"""
+            @{num}{comment}
+            D=A
+        """
+    else:
+        program = f"""
+            @{~num & 0xFFFF}{comment}
+            D=!A
+        """
+    return program
+
+@strip
+def write_load_d(segment: str, num_str: str, namespace: str, comment: str = "") -> str:
+    """
+    Set D to the value of segment[num]. Shared by push and move.
+    Loading a constant is commented with comment, if given.
+    """
 
     num = int(num_str) & 0xFFFF
 
@@ -152,10 +203,7 @@ def write_push(cmd: str, segment: str, num_str: str, namespace: str) -> str:
 
     if segment == "constant":
         # Push a constant onto the stack
-        program += f"""
-            @{num} // {cmd} {segment} {num}
-            D=A
-        """
+        program += write_constant_d(num, comment)
     elif segment == "temp":
         # Push *(temp + num) onto the stack
         actual_num = num + 5
@@ -190,15 +238,20 @@ def write_push(cmd: str, segment: str, num_str: str, namespace: str) -> str:
 
         segment_symbol = SEGMENT_VM_TO_HACK[segment]
 
-        program += f"""
-            @{num}
-            D=A
-            @{segment_symbol}
-            A=D+M
-            D=M
-        """
+        if num <= MAX_CHAINED_LOAD_OFFSET:
+            program += f"""
+                {write_segment_address(segment_symbol, num)}
+                D=M
+            """
+        else:
+            program += f"""
+                @{num}
+                D=A
+                @{segment_symbol}
+                A=D+M
+                D=M
+            """
 
-    program += write_push_d()
     return program
 
 @strip
@@ -222,81 +275,129 @@ def write_pop(segment: str, num_str: str, namespace: str) -> str:
 
     assert segment in ("temp", "local", "this", "that", "pointer", "argument", "static"), f"{segment}"
 
-    program = ""
+    if segment in ("temp", "pointer", "static") or num <= MAX_INLINE_OFFSET:
+        # The address is fixed, or a short A=M+1 chain away: pop into
+        # D and store it there
+        return write_fill_d() + "\n" + write_store_d(segment, num_str, namespace)
 
-    if segment == "temp":
-        # Write directly into RAM[temp+num]
-        segment_symbol = SEGMENT_VM_TO_HACK[segment]
-        assert segment_symbol == "5"
+    segment_symbol = SEGMENT_VM_TO_HACK[segment]
 
-        actual_num = num + 5
-        program += f"""
-            // Pop from stack
-            @SP
-            AM=M-1  // SP = SP-1, A = addr of top
-            D=M     // D = value at top
+    program = f"""
+        // Save the write address
+        @{num}
+        D=A
+        @{segment_symbol}
+        D=D+M
+        @R15
+        M=D // save write addr in R15
 
-            // Write to saved location
-            @{actual_num}
-            M=D
-        """
-    elif segment == "pointer":
-        # Write to RAM[THIS] or RAM[THAT]
+        // Pop from stack
+        @SP
+        AM=M-1 // SP = SP-1; A points to top of stack
+        D=M    // D = value at top of stack
 
-        assert num in (0, 1), f"num = {num} unexpected for pointer"
-        seg = "THIS" if num == 0 else "THAT"
+        // Write to saved location
+        @R15
+        A=M
+        M=D
+    """
+    return program
 
-        program += f"""
-            @{seg} // Save the write address
-            D=A
-            @R15
-            M=D // save write addr in R15
 
-            @SP     // Pop from stack
-            AM=M-1  // SP = SP-1, A = addr of top
-            D=M     // D = value at top
+# Offsets up to this size are reached with A=M+1, A=A+1, ... rather
+# than by computing the address into a scratch register.
+MAX_INLINE_OFFSET = 4
 
-            @R15    // Write to saved location
-            A=M
-            M=D
-        """
-    elif segment == "static":
-        # Pop from Static.{num}
+# Loading segment[num] takes @num, D=A, @SEGMENT, A=D+M, D=M otherwise,
+# so longer chains don't pay off
+MAX_CHAINED_LOAD_OFFSET = 2
 
-        static_var = f"{namespace}.{num}"
+def write_segment_address(segment_symbol: str, num: int) -> str:
+    """
+    Set A to RAM[segment_symbol] + num, for num up to MAX_INLINE_OFFSET.
+    """
+    assert 0 <= num <= MAX_INLINE_OFFSET, f"{num}"
+    lines = [f"@{segment_symbol}", "A=M" if num == 0 else "A=M+1"] + ["A=A+1"] * (num - 1)
+    return "\n".join(lines)
 
-        program += f"""
-            @SP    // pop from stack
-            AM=M-1 // SP = SP-1, A = addr of top
-            D=M    // D = value at top
+@strip
+def write_store_d(segment: str, num_str: str, namespace: str) -> str:
+    """
+    segment[num] = D. Large offsets into local/argument/this/that keep
+    the value in R13 and the address in R15.
+    """
+    assert segment in ("temp", "local", "this", "that", "pointer", "argument", "static"), f"{segment}"
 
-            @{static_var} // write to static var
+    num = int(num_str) & 0xFFFF
+
+    if segment == "temp":
+        program = f"""
+            @{num + 5}
+            M=D
+        """
+    elif segment == "pointer":
+        assert num in (0, 1), f"num = {num} unexpected for pointer"
+        program = f"""
+            @{"THIS" if num == 0 else "THAT"}
+            M=D
+        """
+    elif segment == "static":
+        program = f"""
+            @{namespace}.{num}
+            M=D
+        """
+    elif num <= MAX_INLINE_OFFSET:
+        program = f"""
+            {write_segment_address(SEGMENT_VM_TO_HACK[segment], num)}
             M=D
         """
     else:
-        segment_symbol = SEGMENT_VM_TO_HACK[segment]
-
-        program += f"""
-            // Save the write address
+        program = f"""
+            @R13
+            M=D     // R13 = value
             @{num}
             D=A
-            @{segment_symbol}
+            @{SEGMENT_VM_TO_HACK[segment]}
             D=D+M
             @R15
-            M=D // save write addr in R15
-
-            // Pop from stack
-            @SP
-            AM=M-1 // SP = SP-1; A points to top of stack
-            D=M    // D = value at top of stack
-
-            // Write to saved location
+            M=D     // R15 = address
+            @R13
+            D=M
             @R15
             A=M
             M=D
         """
     return program
 
+@strip
+def write_move(src_segment: str, src_num: int, dst_segment: str, dst_num: int, namespace: str) -> str:
+    """
+    segment[num] = segment'[num'] through D, without touching the stack.
+    Replaces "push src_segment src_num; pop dst_segment dst_num".
+    """
+    dst_num = int(dst_num) & 0xFFFF
+    load = write_load_d(src_segment, src_num, namespace)
+
+    if dst_segment in ("temp", "pointer", "static") or dst_num <= MAX_INLINE_OFFSET:
+        return load + "\n" + write_store_d(dst_segment, dst_num, namespace)
+
+    return f"""
+        // Save the write address
+        @{dst_num}
+        D=A
+        @{SEGMENT_VM_TO_HACK[dst_segment]}
+        D=D+M
+        @R13
+        M=D
+
+        {load}
+
+        // Write to saved location
+        @R13
+        A=M
+        M=D
+    """
+
 
 @strip
 def write_label(label_name: str, namespace: Optional[str]) -> str:
@@ -342,6 +443,24 @@ def write_if_goto(label_name: str, namespace: str) -> str:
 
     return program
 
+@strip
+def write_compare_goto(op: str, label_name: str, namespace: str) -> str:
+    """
+    Pop y and x, and jump to the label if x <cond> y. Replaces a
+    comparison, an optional not and if-goto.
+    """
+    program = f"""
+        @SP
+        AM=M-1 // SP = SP-1; A = address of y
+        D=M    // D = y
+        @SP
+        AM=M-1 // SP = SP-1; A = address of x
+        D=M-D  // D = x - y
+        @{namespace}.{label_name}
+        D;{COMPARE_GOTO_JUMPS[op]}
+    """
+    return program
+
 @strip
 def write_function(function_name: str, num_vars: int) -> str:
     """
@@ -517,7 +636,7 @@ def write_return() -> str:
         @LCL       // A = &LCL
         M=D        // LCL = *(frame''' - 1)
 
-        // goto ret_addr
+        // jump to ret_addr
         @ret_addr  // A = &ret_addr
         A=M        // A = *A = ret_addr
         0;JMP
@@ -525,10 +644,401 @@ def write_return() -> str:
     return program
 
 
+# Frameless calls to leaf functions (see vm_passes.FrameElision). The
+# callee runs on the caller's segments and the return address is in R14.
+
+@strip
+def write_call_leaf(function_name: str, num_args: int, label_count: Dict[str,int]) -> str:
+    """
+    Jump to the function with the return address in R14. The callee
+    leaves its return value on top of the arguments, so afterwards
+    move it down to where the first argument was.
+    """
+    return_address_prefix = f"{function_name}.call"
+    idx_call = label_count.setdefault(return_address_prefix, 0)
+    return_address_label = f"{return_address_prefix}.{idx_call}"
+    label_count[return_address_prefix] += 1
+
+    program = f"""
+        @{return_address_label}
+        D=A
+        @R14
+        M=D        // R14 = return address
+        @{function_name}
+        0;JMP
+        ({return_address_label})
+    """
+    if num_args > 0:
+        drop_args = "\n".join(["M=M-1 // SP = SP-1"] * num_args)
+        program += f"""
+            @SP
+            A=M-1
+            D=M        // D = return value
+            @SP
+            {drop_args}
+            A=M-1
+            M=D        // replace the first argument
+        """
+    return program
+
+@strip
+def write_return_leaf() -> str:
+    program = """
+        @R14
+        A=M
+        0;JMP
+    """
+    return program
+
+
+# Code-size mode: call, return and comparisons jump to one shared copy
+# of their code instead of inlining it at every site.
+#
+#   $$CALL:   R13 = function address, R14 = nArgs, D = return address
+#   $$RETURN: no arguments; the return address is in the frame
+#   $$EQ/$$GT/$$LT: D = return address, saved in R15
+
+# Jump taken when x <cmp> y is true, given D = x - y
+CMP_JUMPS = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+COMPARE_GOTO_JUMPS = {
+    "if-eq": "JEQ", "if-ne": "JNE",
+    "if-gt": "JGT", "if-ge": "JGE",
+    "if-lt": "JLT", "if-le": "JLE",
+}
+
+@strip
+def write_call_shared(function_name: str, num_args: int, label_count: Dict[str,int]) -> str:
+    """
+    Call through $$CALL. Return address labels are numbered the same
+    way as in write_call.
+    """
+    return_address_prefix = f"{function_name}.call"
+    idx_call = label_count.setdefault(return_address_prefix, 0)
+    return_address_label = f"{return_address_prefix}.{idx_call}"
+    label_count[return_address_prefix] += 1
+
+    program = f"""
+        @{function_name}
+        D=A
+        @R13
+        M=D        // R13 = function address
+        @{num_args}
+        D=A
+        @R14
+        M=D        // R14 = nArgs
+        @{return_address_label}
+        D=A        // D = return address
+        @$$CALL
+        0;JMP
+        ({return_address_label})
+    """
+    return program
+
+@strip
+def write_return_shared() -> str:
+    program = """
+        @$$RETURN
+        0;JMP
+    """
+    return program
+
+@strip
+def write_cmp_shared(token: str, label_count: Dict[str,int]) -> str:
+    """
+    "eq", "gt" or "lt" through $$EQ, $$GT or $$LT.
+    """
+    label = f"{token}_{label_count.setdefault(token, 0)}"
+    label_count[token] += 1
+
+    program = f"""
+        @{label}
+        D=A
+        @$${token.upper()}
+        0;JMP
+        ({label})
+    """
+    return program
+
+@strip
+def write_shared_routines() -> str:
+    """
+    The routines that code-size mode jumps to. Starts by jumping over
+    them, so they can go anywhere in a program.
+    """
+    program_chunks = [
+        """
+            @$$END
+            0;JMP
+
+            ($$CALL)
+        """,
+        write_push_d(),  # return address
+        write_push_pointer("LCL"),
+        write_push_pointer("ARG"),
+        write_push_pointer("THIS"),
+        write_push_pointer("THAT"),
+        """
+            // ARG = SP - 5 - nArgs
+            @SP
+            D=M
+            @5
+            D=D-A
+            @R14
+            D=D-M
+            @ARG
+            M=D
+
+            // LCL = SP
+            @SP
+            D=M
+            @LCL
+            M=D
+
+            // goto function
+            @R13
+            A=M
+            0;JMP
+
+            ($$RETURN)
+        """,
+        write_return(),
+    ]
+
+    for token, jump in CMP_JUMPS.items():
+        # Leave true on the stack and go straight back if the test
+        # passes, otherwise overwrite it with false.
+        program_chunks.append(f"""
+            ($${token.upper()})
+            @R15
+            M=D     // R15 = return address
+            @SP
+            AM=M-1  // SP = SP - 1; A = SP - 1
+            D=M     // D = "y"
+            A=A-1   // point to "x"
+            D=M-D   // D = "x-y"
+            M=-1    // top of stack = true
+            @R15
+            A=M
+            D;{jump}
+            @SP
+            A=M-1
+            M=0     // top of stack = false
+            @R15
+            A=M
+            0;JMP
+        """)
+
+    program_chunks.append("($$END)")
+    return "\n".join(program_chunks)
+
+
+# Top-of-stack caching: between commands the top of the VM stack may
+# be held in D instead of RAM[SP-1]. SP doesn't count it, so spilling
+# it is just a push of D.
+CACHED_BINARY_OPS = {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}
+CACHED_UNARY_OPS = {"neg": "D=-D", "not": "D=!D"}
+
+@strip
+def write_fill_d() -> str:
+    """
+    Pop the top of the stack into D.
+    """
+    program = """
+        @SP
+        AM=M-1
+        D=M
+    """
+    return program
+
+@strip
+def write_spill_d() -> str:
+    """
+    Push D onto the stack, bumping SP first: one instruction shorter
+    than write_push_d, which the peephole optimizer's patterns expect.
+    """
+    program = """
+        @SP
+        M=M+1
+        A=M-1
+        M=D
+    """
+    return program
+
+@strip
+def write_binary_cached(token: str) -> str:
+    """
+    D = x <op> y, with y in D and x on top of the stack.
+    """
+    program = f"""
+        @SP
+        AM=M-1
+        {CACHED_BINARY_OPS[token]}
+    """
+    return program
+
+@strip
+def write_add_constant(token: str, num: int) -> str:
+    """
+    "push constant num" then "add" or "sub", done in place on the top
+    of the stack.
+    """
+    num = num & 0xFFFF
+    if token == "sub":
+        num = -num & 0xFFFF
+
+    if num == 0:
+        return ""
+    if num == 1 or num == 0xFFFF:
+        program = f"""
+            @SP
+            A=M-1
+            M=M{"+" if num == 1 else "-"}1
+        """
+        return program
+
+    program = f"""
+        {write_constant_d(num)}
+        @SP
+        A=M-1
+        M=D+M
+    """
+    return program
+
+@strip
+def write_add_constant_cached(token: str, num: int) -> str:
+    """
+    Like write_add_constant, with the top of the stack in D.
+    """
+    num = num & 0xFFFF
+    if token == "sub":
+        num = -num & 0xFFFF
+
+    if num == 0:
+        program = ""
+    elif num == 1 or num == 0xFFFF:
+        program = f"D=D{'+' if num == 1 else '-'}1"
+    elif num < 0x8000:
+        program = f"""
+            @{num}
+            D=D+A
+        """
+    elif num > 0x8000:
+        program = f"""
+            @{-num & 0xFFFF}
+            D=D-A
+        """
+    else:
+        program = """
+            @32767
+            D=D-A
+            D=D-1
+        """
+    return program
+
+@strip
+def write_cmp_cached(token: str, label_count: Dict[str,int]) -> str:
+    """
+    D = x <cmp> y, with y in D and x on top of the stack.
+    """
+    label = f"{token}_{label_count.setdefault(token, 0)}"
+    label_count[token] += 1
+
+    program = f"""
+        @SP
+        AM=M-1
+        D=M-D      // D = x - y
+        @{label}
+        D;{CMP_JUMPS[token]}
+        D=0
+        @{label}.END
+        0;JMP
+        ({label})
+        D=-1
+        ({label}.END)
+    """
+    return program
+
+@strip
+def write_compare_goto_cached(op: str, label_name: str, namespace: str) -> str:
+    """
+    Jump to the label if x <cond> y, with y in D and x on top of the stack.
+    """
+    program = f"""
+        @SP
+        AM=M-1
+        D=M-D  // D = x - y
+        @{namespace}.{label_name}
+        D;{COMPARE_GOTO_JUMPS[op]}
+    """
+    return program
+
+@strip
+def write_if_goto_cached(label_name: str, namespace: str) -> str:
+    """
+    Jump to the label if D, the cached top of the stack, is nonzero.
+    """
+    program = f"""
+        @{namespace}.{label_name}
+        D;JNE
+    """
+    return program
+
+
+# Templates with numbered labels (comparisons, call return addresses)
+# are expanded once with this in place of the number, then numbered
+# with str.replace. NUL can't appear in VM or Hack source.
+LABEL_PLACEHOLDER = "\0"
+
+class _LabelNumber(int):
+    """
+    Stands in for a label_count entry; formats as LABEL_PLACEHOLDER.
+    """
+    def __format__(self, spec: str) -> str:
+        return LABEL_PLACEHOLDER
+
+
+def strip_program(program: str) -> str:
+    return remove_whitespace(remove_comments(program))
+
+
+def _is_constant_push(command: VMCommand) -> bool:
+    return command.op == "push" and command.arg1 == "constant"
+
+
 class Translator:
-    def __init__(self):
+    def __init__(
+        self, optimize: bool = False, shared_routines: bool = False, cache_top: bool = False, file_labels: bool = False
+    ):
+        """
+        Args:
+            optimize: run the VM optimization passes from vm_passes
+            shared_routines: code-size mode. Calls, returns and
+                comparisons jump to the code from write_shared_routines,
+                which has to be somewhere in the program.
+            cache_top: keep the top of the stack in D between commands,
+                spilling it only where control flow meets
+            file_labels: number generated labels per .vm file and put
+                the file name in them (eq_Main.0 rather than eq_12), so
+                each file translates the same on its own
+        """
         self.label_count: Dict[str,int] = {}
-
+        self.optimize = optimize
+        self.shared_routines = shared_routines
+        self.cache_top = cache_top
+        self.file_labels = file_labels
+        self.top_in_d = False
+        self.passes = PassManager()
+        if optimize:
+            register_optimizations(self.passes)
+
+        # Expanded templates, keyed by (strip, write function, arguments)
+        self.expansions: Dict[tuple, str] = {}
+        self.strip_output = False
+
+        # With defer_numbering, expand_numbered leaves the placeholder in
+        # and puts the label in numbered_label (see emit_words)
+        self.defer_numbering = False
+        self.numbered_label: Optional[str] = None
 
     def translate(self, program: str, namespace: str = "default") -> str:
         """
@@ -538,76 +1048,271 @@ class Translator:
             program: VM code
             namespace: should be the basename of the program file, e.g. MyProgram
         """
+        return self.translate_commands(parse_vm(program, namespace))
 
-        out_paragraphs = []
-        lines = [line.strip() for line in program.splitlines()]
+    def translate_commands(self, commands: List[VMCommand]) -> str:
+        """
+        Run the passes over parsed VM commands and translate them.
+        """
+        return self.emit(self.passes.run(commands))
 
-        for line_number, line in enumerate(lines):
-            # Remove extra whitespace
+    def options(self) -> Dict[str, bool]:
+        return dict(
+            optimize=self.optimize,
+            shared_routines=self.shared_routines,
+            cache_top=self.cache_top,
+            file_labels=self.file_labels,
+        )
 
-            # Discard comment if any
-            idx_comment = line.find("//")
-            if idx_comment != -1:
-                line = line[:idx_comment]
+    def with_same_options(self) -> "Translator":
+        """
+        A fresh Translator with the same options, without any passes
+        registered since.
+        """
+        return Translator(**self.options())
 
-            # Split into tokens. Expect one or three.
-            tokens = line.split()
-            if not tokens:
+    def emit(self, commands: List[VMCommand]) -> str:
+        """
+        Write Hack assembly for parsed VM commands, each one preceded by
+        a "// <vm command>" comment.
+        """
+        out = io.StringIO()
+        self.emit_to(out, commands)
+        return out.getvalue()[:-1]
+
+    def translate_to(self, fh: TextIO, program: str, namespace: str = "default", strip: bool = False):
+        """
+        Like translate, but write the assembly to fh as it goes.
+        """
+        self.emit_to(fh, self.passes.run(parse_vm(program, namespace)), strip)
+
+    def emit_to(self, fh: TextIO, commands: List[VMCommand], strip: bool = False):
+        """
+        Write Hack assembly for parsed VM commands to fh, each paragraph
+        followed by a newline.
+
+        Args:
+            strip: leave out comments and blank lines, like --strip
+        """
+        write = fh.write
+        self.strip_output = strip
+
+        for command, program in self.write_commands(commands):
+            if strip:
+                if program:
+                    write(program)
+                    write("\n")
+            else:
+                write(f"// {command}\n")
+                write(program)
+                write("\n")
+
+        if self.top_in_d:
+            write(self.spill())
+            write("\n")
+
+    def emit_words(self, writer: MachineCodeWriter, commands: List[VMCommand]):
+        """
+        Like emit_to, but assemble straight into machine code. Templates
+        go to the writer with their label numbers left out, so that it
+        only compiles each one once.
+        """
+        self.strip_output = True
+        self.defer_numbering = True
+        try:
+            self.numbered_label = None
+            for command, program in self.write_commands(commands):
+                writer.write(program, self.numbered_label)
+                self.numbered_label = None
+
+            if self.top_in_d:
+                writer.write(self.spill())
+        finally:
+            self.defer_numbering = False
+
+    def write_commands(self, commands: List[VMCommand]) -> Iterator[Tuple[VMCommand, str]]:
+        """
+        Each command with its assembly. A "push constant" right before
+        add or sub is folded into it: the code comes out with the push,
+        and the add or sub gets none.
+        """
+        for ii, command in enumerate(commands):
+            if ii > 0 and command.op in ("add", "sub") and _is_constant_push(commands[ii - 1]):
                 continue
 
-            cmd = tokens[0]
-
-            program = ""
-
-            if cmd == "eq":
-                program = write_cmp("eq", "JNE", self.label_count)
-            elif cmd == "gt":
-                program = write_cmp("gt", "JLE", self.label_count)
-            elif cmd == "lt":
-                program = write_cmp("lt", "JGE", self.label_count)
-            elif cmd == "not":
-                program = write_not()
-            elif cmd == "neg":
-                program = write_neg()
-            elif cmd == "and":
-                program = write_and()
-            elif cmd == "or":
-                program = write_or()
-            elif cmd == "add":
-                program = write_add()
-            elif cmd == "sub":
-                program = write_sub()
-            elif cmd == "push":
-                program = write_push(cmd, tokens[1], tokens[2], namespace)
-            elif cmd == "pop":
-                program = write_pop(tokens[1], tokens[2], namespace)
-            elif cmd == "label":
-                program = write_label(tokens[1], namespace)
-                pass
-            elif cmd == "goto":
-                program = write_goto(tokens[1], namespace)
-                pass
-            elif cmd == "if-goto":
-                program = write_if_goto(tokens[1], namespace)
-                pass
-            elif cmd == "function":
-                # namespace assumed to be part of the function name, so
-                # we don't pass that in.
-                program = write_function(tokens[1], int(tokens[2]))
-                pass
-            elif cmd == "call":
-                program = write_call(tokens[1], int(tokens[2]), self.label_count)
-                pass
-            elif cmd == "return":
-                program = write_return()
-                pass
+            following = commands[ii + 1] if ii + 1 < len(commands) else None
+            if following is not None and following.op in ("add", "sub") and _is_constant_push(command):
+                yield command, self.write_add_constant(following.op, command.arg2)
+                yield following, ""
+            elif self.cache_top:
+                yield command, self.write_command_cached(command)
             else:
-                parsing_error(line_number, line)
+                yield command, self.write_command(command)
 
-            out_paragraphs.append(f"// {' '.join(tokens)}")
-            out_paragraphs.append(program)
+    def write_add_constant(self, token: str, num: int) -> str:
+        if not self.cache_top:
+            return self.expand(write_add_constant, token, num)
+        chunks = [self.fill(), self.expand(write_add_constant_cached, token, num)]
+        return "\n".join(chunk for chunk in chunks if chunk)
 
-        return "\n".join(out_paragraphs)
+    def expand(self, func: Callable[..., str], *args) -> str:
+        """
+        func(*args), computed once per Translator. The write_* functions
+        always give the same code for the same arguments.
+        """
+        key = (self.strip_output, func, *args)
+        program = self.expansions.get(key)
+        if program is None:
+            program = func(*args)
+            if self.strip_output:
+                program = strip_program(program)
+            self.expansions[key] = program
+        return program
+
+    def expand_numbered(self, namespace: str, prefix: str, func: Callable[..., str], *args) -> str:
+        """
+        Like expand for functions taking label_count as their last
+        argument: the template is cached, and numbered from the
+        label_count entry for prefix (per namespace with file_labels).
+        """
+        key = (self.strip_output, func, prefix, *args)
+        template = self.expansions.get(key)
+        if template is None:
+            template = func(*args, {prefix: _LabelNumber()})
+            if self.strip_output:
+                template = strip_program(template)
+            self.expansions[key] = template
+
+        if self.file_labels:
+            prefix = f"{namespace}.{prefix}"
+        number = self.label_count.setdefault(prefix, 0)
+        self.label_count[prefix] += 1
+
+        label = f"{namespace}.{number}" if self.file_labels else str(number)
+        if self.defer_numbering:
+            self.numbered_label = label
+            return template
+        return template.replace(LABEL_PLACEHOLDER, label)
+
+    def fill(self) -> str:
+        """
+        Make sure the top of the stack is in D.
+        """
+        if self.top_in_d:
+            return ""
+        self.top_in_d = True
+        return self.expand(write_fill_d)
+
+    def spill(self) -> str:
+        """
+        Make sure the top of the stack is in RAM.
+        """
+        if not self.top_in_d:
+            return ""
+        self.top_in_d = False
+        return self.expand(write_spill_d)
+
+    def write_command_cached(self, command: VMCommand) -> str:
+        """
+        Like write_command, for cache_top mode. Everything that isn't
+        stack arithmetic spills D first and uses the usual templates.
+        """
+        cmd = command.op
+        namespace = command.namespace
+        expand = self.expand
+
+        if cmd == "push":
+            num = int(command.arg2) & 0xFFFF
+            chunks = [self.spill(), expand(write_load_d, command.arg1, command.arg2, namespace, f"push {command.arg1} {num}")]
+            self.top_in_d = True
+        elif cmd in CACHED_BINARY_OPS:
+            chunks = [self.fill(), expand(write_binary_cached, cmd)]
+        elif cmd in CACHED_UNARY_OPS:
+            chunks = [self.fill(), CACHED_UNARY_OPS[cmd]]
+        elif cmd in CMP_JUMPS and not self.shared_routines:
+            chunks = [self.fill(), self.expand_numbered(namespace, cmd, write_cmp_cached, cmd)]
+        elif cmd == "pop":
+            chunks = [self.fill(), expand(write_store_d, command.arg1, command.arg2, namespace)]
+            self.top_in_d = False
+        elif cmd == "if-goto":
+            chunks = [self.fill(), expand(write_if_goto_cached, command.arg1, namespace)]
+            self.top_in_d = False
+        elif cmd in COMPARE_GOTO_JUMPS:
+            chunks = [self.fill(), expand(write_compare_goto_cached, cmd, command.arg1, namespace)]
+            self.top_in_d = False
+        else:
+            chunks = [self.spill(), self.write_command(command)]
+
+        return "\n".join(chunk for chunk in chunks if chunk)
+
+    def write_command(self, command: VMCommand) -> str:
+        cmd = command.op
+        namespace = command.namespace
+        expand = self.expand
+
+        if cmd in CMP_JUMPS and self.shared_routines:
+            program = self.expand_numbered(namespace, cmd, write_cmp_shared, cmd)
+        elif cmd == "eq":
+            program = self.expand_numbered(namespace, cmd, write_cmp, "eq", "JNE")
+        elif cmd == "gt":
+            program = self.expand_numbered(namespace, cmd, write_cmp, "gt", "JLE")
+        elif cmd == "lt":
+            program = self.expand_numbered(namespace, cmd, write_cmp, "lt", "JGE")
+        elif cmd == "not":
+            program = expand(write_not)
+        elif cmd == "neg":
+            program = expand(write_neg)
+        elif cmd == "and":
+            program = expand(write_and)
+        elif cmd == "or":
+            program = expand(write_or)
+        elif cmd == "add":
+            program = expand(write_add)
+        elif cmd == "sub":
+            program = expand(write_sub)
+        elif cmd == "push":
+            program = expand(write_push, cmd, command.arg1, command.arg2, namespace)
+        elif cmd == "pop":
+            program = expand(write_pop, command.arg1, command.arg2, namespace)
+        elif cmd == "move":
+            program = expand(write_move, command.arg1, command.arg2, command.arg3, command.arg4, namespace)
+        elif cmd == "label":
+            program = expand(write_label, command.arg1, namespace)
+        elif cmd == "goto":
+            program = expand(write_goto, command.arg1, namespace)
+        elif cmd == "if-goto":
+            program = expand(write_if_goto, command.arg1, namespace)
+        elif cmd in COMPARE_GOTO_JUMPS:
+            program = expand(write_compare_goto, cmd, command.arg1, namespace)
+        elif cmd == "function":
+            # namespace assumed to be part of the function name, so
+            # we don't pass that in.
+            program = expand(write_function, command.arg1, command.arg2)
+        elif cmd == "call" and self.shared_routines:
+            program = self.expand_numbered(namespace, f"{command.arg1}.call", write_call_shared, command.arg1, command.arg2)
+        elif cmd == "call":
+            program = self.expand_numbered(namespace, f"{command.arg1}.call", write_call, command.arg1, command.arg2)
+        elif cmd == "call-leaf":
+            program = self.expand_numbered(namespace, f"{command.arg1}.call", write_call_leaf, command.arg1, command.arg2)
+        elif cmd == "function-leaf":
+            program = expand(write_label, command.arg1, None)
+        elif cmd == "return-leaf":
+            program = expand(write_return_leaf)
+        elif cmd == "return" and self.shared_routines:
+            program = expand(write_return_shared)
+        elif cmd == "return":
+            program = expand(write_return)
+        else:
+            parsing_error(command.line_number, str(command))
+
+        return program
+
+
+def translate(program: str, namespace: str = "default") -> str:
+    """
+    Translate a VM program with a fresh Translator.
+    """
+    return Translator().translate(program, namespace)
 
 
 def normalize_arguments(input_filepath: str, output_filepath: Optional[str] = None) -> Tuple[List[Path], Path, bool]:
@@ -643,6 +1348,216 @@ def normalize_arguments(input_filepath: str, output_filepath: Optional[str] = No
     return input_files, output_file, do_init
 
 
+def translate_files(
+    tor: Translator,
+    input_files: List[Path],
+    do_init: bool,
+    whole_program: bool = False,
+    jobs: Optional[int] = None,
+    cache: Optional[TranslationCache] = None,
+) -> str:
+    """
+    Translate .vm files into one Hack program, with the bootstrap code
+    first if do_init.
+
+    Args:
+        whole_program: give the passes all the files at once, instead
+            of one file at a time
+        jobs, cache: see translate_files_to
+    """
+    out = io.StringIO()
+    translate_files_to(out, tor, input_files, do_init, whole_program, jobs=jobs, cache=cache)
+    return out.getvalue()[:-1]
+
+
+def translate_file(options: Dict[str, bool], strip: bool, namespace: str, program: str) -> str:
+    """
+    Translate one .vm file with a fresh Translator. Runs in the worker
+    processes of translate_files_to.
+    """
+    out = io.StringIO()
+    Translator(**options).translate_to(out, program, namespace, strip)
+    return out.getvalue()
+
+
+def translate_files_to(
+    fh: TextIO,
+    tor: Translator,
+    input_files: List[Path],
+    do_init: bool,
+    whole_program: bool = False,
+    strip: bool = False,
+    jobs: Optional[int] = None,
+    cache: Optional[TranslationCache] = None,
+):
+    """
+    Like translate_files, but write the program to fh as it goes, one
+    file at a time unless whole_program. Give it a buffered file and
+    nothing but the current file's commands is held in memory.
+
+    Args:
+        jobs: translate the files on a pool of this many processes. Needs
+            a Translator with file_labels, so that each file comes out
+            the same wherever it's translated; the output is identical
+            to translating with tor, whatever the number of jobs.
+        cache: reuse the translation of any file that hasn't changed
+            since it was last translated with the same options, and
+            store the others. Also needs file_labels.
+    """
+    def write_chapter(program: str):
+        fh.write(strip_program(program) if strip else program)
+        fh.write("\n")
+
+    if do_init:
+        write_chapter(write_bootstrap_sp())
+
+    if whole_program:
+        if tor.shared_routines:
+            write_chapter(write_shared_routines())
+
+        commands = parse_vm("call Sys.init 0", "init") if do_init else []
+        for file in input_files:
+            commands.extend(parse_vm(file.read_text(), file.stem))
+        tor.emit_to(fh, tor.passes.run(commands), strip)
+        return
+
+    if do_init:
+        tor.translate_to(fh, "call Sys.init 0", "init", strip)
+
+    if tor.shared_routines:
+        write_chapter(write_shared_routines())
+
+    if jobs is None and cache is None:
+        for file in input_files:
+            tor.translate_to(fh, file.read_text(), file.stem, strip)
+        return
+
+    assert tor.file_labels, "parallel and cached translation need file_labels"
+    assert tor.passes.names() == tor.with_same_options().passes.names(), \
+        "only the standard passes run in worker processes"
+
+    options = tor.options()
+    namespaces = [file.stem for file in input_files]
+    programs = [file.read_text() for file in input_files]
+
+    chapters: List[Optional[str]] = [None]*len(input_files)
+    if cache is not None:
+        keys = [cache.key(program, ns, options, strip) for ns, program in zip(namespaces, programs)]
+        chapters = [cache.get(key) for key in keys]
+    todo = [ii for ii, chapter in enumerate(chapters) if chapter is None]
+
+    translate = partial(translate_file, options, strip)
+    todo_namespaces = [namespaces[ii] for ii in todo]
+    todo_programs = [programs[ii] for ii in todo]
+
+    if jobs is None or jobs == 1 or len(todo) <= 1:
+        translated = list(map(translate, todo_namespaces, todo_programs))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            # map yields in input order, however the work was scheduled
+            chunksize = max(1, len(todo) // (4*jobs))
+            translated = list(pool.map(translate, todo_namespaces, todo_programs, chunksize=chunksize))
+
+    for ii, chapter in zip(todo, translated):
+        chapters[ii] = chapter
+        if cache is not None:
+            cache.put(keys[ii], chapter)
+
+    for chapter in chapters:
+        fh.write(chapter)
+
+
+def assemble_files(tor: Translator, input_files: List[Path], do_init: bool, whole_program: bool = False) -> Assembled:
+    """
+    Translate .vm files straight to machine code, the same as
+    assembling the output of translate_files without the text.
+    """
+    writer = MachineCodeWriter(placeholder=LABEL_PLACEHOLDER)
+
+    if do_init:
+        writer.write(write_bootstrap_sp())
+
+    if whole_program:
+        if tor.shared_routines:
+            writer.write(write_shared_routines())
+
+        commands = parse_vm("call Sys.init 0", "init") if do_init else []
+        for file in input_files:
+            commands.extend(parse_vm(file.read_text(), file.stem))
+        tor.emit_words(writer, tor.passes.run(commands))
+        return writer.finish()
+
+    if do_init:
+        tor.emit_words(writer, tor.passes.run(parse_vm("call Sys.init 0", "init")))
+
+    if tor.shared_routines:
+        writer.write(write_shared_routines())
+
+    for file in input_files:
+        tor.emit_words(writer, tor.passes.run(parse_vm(file.read_text(), file.stem)))
+
+    return writer.finish()
+
+
+def write_bootstrap_sp() -> str:
+    return remove_whitespace("""
+        @256
+        D=A
+        @SP
+        M=D
+    """)
+
+
+def dead_function_report(tor: Translator, removed: Dict[str, List[VMCommand]]) -> str:
+    """
+    Removed functions, and how much code each would have taken when
+    translated with tor's options.
+    """
+    sizes = {name: count_instructions(tor.with_same_options().translate_commands(block)) for name, block in removed.items()}
+    total = sum(sizes.values())
+
+    lines = [f"removed {len(sizes)} functions, {total} instructions ({2*total} bytes of ROM)"]
+    width = max((len(name) for name in sizes), default=0)
+    for name in sorted(sizes):
+        lines.append(f"    {name:<{width}}  {sizes[name]:6d}")
+    return "\n".join(lines)
+
+
+def frame_elision_report(elided: List[str]) -> str:
+    lines = [f"elided the frames of {len(elided)} leaf functions"]
+    lines += [f"    {name}" for name in sorted(elided)]
+    return "\n".join(lines)
+
+
+def inline_report(inlined: Dict[str, int]) -> str:
+    lines = [f"inlined {sum(inlined.values())} calls to {len(inlined)} functions"]
+    lines += [f"    {name}: {count}" for name, count in sorted(inlined.items())]
+    return "\n".join(lines)
+
+
+def count_instructions(program: str) -> int:
+    """
+    Number of A- and C-instructions in a Hack program.
+    """
+    lines = remove_whitespace(remove_comments(program)).splitlines()
+    return sum(1 for line in lines if not line.startswith("("))
+
+
+# Extra cycles code-size mode spends at run time, measured against
+# the inline code (see test_vm_translator.py)
+SHARED_CALL_RETURN_CYCLES = 13
+SHARED_CMP_TRUE_CYCLES = 4
+SHARED_CMP_FALSE_CYCLES = 13
+
+def shared_routines_report(inline_size: int, shared_size: int) -> str:
+    saved = inline_size - shared_size
+    return (
+        f"code size: {inline_size} => {shared_size} instructions "
+        f"({saved} fewer, {100*saved/max(inline_size, 1):.0f}%)\n"
+        f"run time: +{SHARED_CALL_RETURN_CYCLES} cycles per call and return, "
+        f"+{SHARED_CMP_TRUE_CYCLES}/+{SHARED_CMP_FALSE_CYCLES} per true/false comparison"
+    )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -662,36 +1577,153 @@ if __name__ == "__main__":
         action="store_true",
         help="Remove comments and extra whitespace"
     )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Optimize the VM code, then run the peephole optimizer over the generated assembly"
+    )
+    parser.add_argument(
+        "--shared-routines",
+        action="store_true",
+        help="Code-size mode: share one copy of call, return and comparisons, and report the tradeoff"
+    )
+    parser.add_argument(
+        "--cache-top",
+        action="store_true",
+        help="Keep the top of the VM stack in D between commands"
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Drop functions that can't be reached from Sys.init, and report them. Needs a directory"
+    )
+    parser.add_argument(
+        "--inline",
+        action="store_true",
+        help="Inline calls to small leaf functions"
+    )
+    parser.add_argument(
+        "--inline-max-size",
+        type=int,
+        default=12,
+        help="Largest function body, in VM commands, that --inline inlines"
+    )
+    parser.add_argument(
+        "--inline-allow",
+        nargs="*",
+        default=[],
+        help="Functions for --inline to inline whatever their size"
+    )
+    parser.add_argument(
+        "--elide-frames",
+        action="store_true",
+        help="Call leaf functions that don't use locals, arguments or pointer without saving a frame"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Translate files on this many processes, with labels numbered per file"
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="Keep each file's translation in DIR and only retranslate files that changed"
+    )
+    parser.add_argument(
+        "--format",
+        choices=("asm", "hack", "bin"),
+        default="asm",
+        help="Write assembly, or assemble straight to .hack text or packed little-endian words"
+    )
+    parser.add_argument(
+        "--pass-timings",
+        action="store_true",
+        help="Print the time spent in each VM pass"
+    )
     args = parser.parse_args()
 
     input_files, output_file, do_init = normalize_arguments(args.input_path, args.output_file)
-
-    tor = Translator()
-
-    asm_chapters = []
-
-    if do_init:
-        asm_chapters.append(remove_whitespace(f"""
-            @256
-            D=A
-            @SP
-            M=D
-        """))
-
-        asm_chapters.append(tor.translate("""
-            call Sys.init 0
-        """, "init"))
-
-    for file in input_files:
-        with open(file) as fh:
-            contents = fh.read()
-            asm_code = tor.translate(contents, file.stem)
-            asm_chapters.append(asm_code)
-
-    asm_program = "\n".join(asm_chapters)
-    if args.strip:
-        asm_program = remove_whitespace(remove_comments(asm_program))
-
-    with open(output_file, "w") as fh:
-        fh.write(asm_program)
-
+    if args.output_file is None:
+        output_file = output_file.with_suffix(f".{args.format}")
+
+    if args.format != "asm" and (args.optimize or args.jobs is not None or args.cache is not None):
+        parser.error("--optimize, --jobs and --cache work on assembly text; assemble their output instead")
+
+    if args.prune and not do_init:
+        parser.error("--prune needs a directory with Sys.init in it")
+
+    whole_program = args.prune or args.inline or args.elide_frames
+    if whole_program and args.jobs is not None:
+        parser.error("--inline, --prune and --elide-frames need the whole program in one process")
+    if whole_program and args.cache is not None:
+        parser.error("--inline, --prune and --elide-frames translate the whole program together, so can't --cache files")
+
+    cache = TranslationCache(Path(args.cache)) if args.cache is not None else None
+
+    def make_translator(shared_routines: bool) -> Translator:
+        tor = Translator(
+            optimize=args.optimize,
+            shared_routines=shared_routines,
+            cache_top=args.cache_top,
+            file_labels=args.jobs is not None or cache is not None,
+        )
+        if args.inline:
+            names = tor.passes.names()
+            inliner = Inliner(args.inline_max_size, args.inline_allow)
+            tor.passes.register("inline", inliner, before=names[0] if names else None)
+        if args.prune:
+            tor.passes.register("remove_dead_functions", DeadFunctionElimination())
+        if args.elide_frames:
+            tor.passes.register("elide_frames", FrameElision())
+        return tor
+
+    tor = make_translator(args.shared_routines)
+
+    if args.format != "asm":
+        assembled = assemble_files(tor, input_files, do_init, whole_program)
+
+        if args.shared_routines:
+            inline_size = len(assemble_files(make_translator(False), input_files, do_init, whole_program).words)
+            print(shared_routines_report(inline_size, len(assembled.words)))
+
+        if args.format == "hack":
+            with open(output_file, "w") as fh:
+                fh.write(format_hack(assembled.words))
+        else:
+            with open(output_file, "wb") as fh:
+                fh.write(pack_words(assembled.words))
+    elif args.optimize or args.shared_routines:
+        # The peephole optimizer and the size report need the whole program
+        asm_program = translate_files(tor, input_files, do_init, whole_program, args.jobs, cache)
+
+        if args.optimize:
+            asm_program = optimize_program(asm_program)
+
+        if args.shared_routines:
+            inline_program = translate_files(
+                make_translator(False), input_files, do_init, whole_program, args.jobs, cache
+            )
+            if args.optimize:
+                inline_program = optimize_program(inline_program)
+            print(shared_routines_report(count_instructions(inline_program), count_instructions(asm_program)))
+
+        if args.strip:
+            asm_program = strip_program(asm_program)
+
+        with open(output_file, "w") as fh:
+            fh.write(asm_program)
+    else:
+        with open(output_file, "w", buffering=1 << 16) as fh:
+            translate_files_to(fh, tor, input_files, do_init, whole_program, args.strip, args.jobs, cache)
+
+    if args.inline:
+        print(inline_report(tor.passes.get("inline").inlined))
+    if args.elide_frames:
+        print(frame_elision_report(tor.passes.get("elide_frames").elided))
+    if args.prune:
+        print(dead_function_report(tor, tor.passes.get("remove_dead_functions").removed))
+
+    if cache is not None:
+        print(cache.report())
+    if args.pass_timings:
+        print(tor.passes.report())
@@ -0,0 +1,238 @@
+import argparse
+import dataclasses
+from typing import Dict, List, Optional, Sequence
+
+from hackulator import Compy386
+from vm_ir import ARITY
+
+# Number of arguments each VM command takes. Used to tell the
+# "// push constant 7" comments that Translator.translate emits apart
+# from the other comments in the generated assembly.
+VM_COMMAND_ARITY = ARITY
+
+TOPLEVEL = "<toplevel>"
+
+
+def parse_vm_comment(line: str) -> Optional[List[str]]:
+    """
+    Return the tokens of a VM command if the line is a comment-only line
+    holding one, e.g. "// push constant 7". Otherwise return None.
+
+    >>> parse_vm_comment("// call Math.multiply 2")
+    ['call', 'Math.multiply', '2']
+    >>> parse_vm_comment("// frame = LCL") is None
+    True
+    >>> parse_vm_comment("@SP // push D onto the stack") is None
+    True
+    """
+    line = line.strip()
+    if not line.startswith("//"):
+        return None
+
+    tokens = line[2:].split()
+    if not tokens or VM_COMMAND_ARITY.get(tokens[0]) != len(tokens) - 1:
+        return None
+
+    if len(tokens) == 3 and not tokens[2].lstrip("-").isdigit():
+        return None
+
+    return tokens
+
+
+def file_for_function(function_name: Optional[str]) -> str:
+    """
+    Jack puts class Foo in Foo.vm, so function Foo.bar lives in Foo.vm.
+    """
+    if function_name is None:
+        return TOPLEVEL
+    return function_name.split(".")[0]
+
+
+@dataclasses.dataclass
+class VMCommandSite:
+    """
+    A VM command and the range of asm pcs it was translated to.
+    """
+    text: str
+    file: str
+    function: Optional[str]
+    asm_line: int
+    pc_start: int
+    pc_end: int
+
+
+@dataclasses.dataclass
+class FileCoverage:
+    file: str
+    commands_total: int = 0
+    commands_hit: int = 0
+    functions_total: int = 0
+    functions_hit: int = 0
+    missed_functions: List[str] = dataclasses.field(default_factory=list)
+    missed_commands: List[VMCommandSite] = dataclasses.field(default_factory=list)
+
+    @property
+    def line_rate(self) -> float:
+        return self.commands_hit / self.commands_total if self.commands_total else 1.0
+
+    @property
+    def function_rate(self) -> float:
+        return self.functions_hit / self.functions_total if self.functions_total else 1.0
+
+
+def map_vm_commands(lines: Sequence[str], source_lines: Sequence[int]) -> List[VMCommandSite]:
+    """
+    Group asm pcs by the VM command that produced them.
+
+    Args:
+        lines: the assembly source, with the VM comments left in
+        source_lines: source line index of each pc, from Parser.source_lines
+    Returns:
+        one VMCommandSite per VM comment, in program order
+    """
+    sites: List[VMCommandSite] = []
+    function_name: Optional[str] = None
+    pc = 0
+
+    for line_number, line in enumerate(lines):
+        tokens = parse_vm_comment(line)
+        if tokens is None:
+            continue
+
+        # Every pc up to here belongs to the previous command.
+        while pc < len(source_lines) and source_lines[pc] < line_number:
+            pc += 1
+        if sites:
+            sites[-1].pc_end = pc
+
+        if tokens[0] == "function":
+            function_name = tokens[1]
+
+        sites.append(VMCommandSite(
+            text=" ".join(tokens),
+            file=file_for_function(function_name),
+            function=function_name,
+            asm_line=line_number,
+            pc_start=pc,
+            pc_end=pc,
+        ))
+
+    if sites:
+        sites[-1].pc_end = len(source_lines)
+
+    return sites
+
+
+class Coverage:
+    """
+    Run a Hack program and record which pcs were executed.
+
+    The hits bitmap has one byte per instruction, so recording costs
+    one store per executed instruction.
+    """
+
+    def __init__(self, program: str):
+        self.lines = program.splitlines()
+        self.compy = Compy386(program)
+        self.hits = bytearray(len(self.compy.parsed_instructions))
+
+    def run(self, max_steps: int = 1000):
+        """
+        Like Compy386.run, but mark every executed pc.
+        """
+        compy = self.compy
+        hits = self.hits
+        step = compy.step
+        num_instructions = len(hits)
+
+        for s in range(max_steps):
+            pc = compy.pc
+            if pc >= num_instructions:
+                break
+            hits[pc] = 1
+            step()
+
+    def asm_line_hits(self) -> Dict[int, bool]:
+        """
+        Map each asm source line holding an instruction to whether it ran.
+        """
+        return {line: bool(hit) for line, hit in zip(self.compy.source_lines, self.hits)}
+
+    def vm_command_sites(self) -> List[VMCommandSite]:
+        return map_vm_commands(self.lines, self.compy.source_lines)
+
+    def report(self) -> Dict[str, FileCoverage]:
+        """
+        Line and function coverage for each .vm file.
+
+        VM commands that produce no instructions (labels, and functions
+        without locals) are not counted. A function counts as hit if
+        any of its instructions ran.
+        """
+        files: Dict[str, FileCoverage] = {}
+        functions_hit: Dict[str, bool] = {}
+        hits = self.hits
+
+        for site in self.vm_command_sites():
+            cov = files.setdefault(site.file, FileCoverage(site.file))
+
+            if site.function is not None:
+                functions_hit.setdefault(site.function, False)
+
+            if site.pc_start == site.pc_end:
+                continue
+
+            cov.commands_total += 1
+            if any(hits[site.pc_start:site.pc_end]):
+                cov.commands_hit += 1
+                if site.function is not None:
+                    functions_hit[site.function] = True
+            else:
+                cov.missed_commands.append(site)
+
+        for function_name, hit in functions_hit.items():
+            cov = files[file_for_function(function_name)]
+            cov.functions_total += 1
+            if hit:
+                cov.functions_hit += 1
+            else:
+                cov.missed_functions.append(function_name)
+
+        return files
+
+
+def format_report(files: Dict[str, FileCoverage], show_missed: bool = False) -> str:
+    out_lines = [f"{'file':<20} {'lines':>13} {'functions':>13}"]
+
+    for name in sorted(files):
+        cov = files[name]
+        out_lines.append(
+            f"{name + '.vm':<20} "
+            f"{cov.commands_hit:>5}/{cov.commands_total:<5} "
+            f"{cov.functions_hit:>5}/{cov.functions_total:<5} "
+            f"{100*cov.line_rate:5.1f}%"
+        )
+        if show_missed:
+            for function_name in cov.missed_functions:
+                out_lines.append(f"    never called: {function_name}")
+            for site in cov.missed_commands:
+                if site.function not in cov.missed_functions:
+                    out_lines.append(f"    not run: {site.function}: {site.text} (asm line {site.asm_line + 1})")
+
+    return "\n".join(out_lines)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser("hack_coverage", description="VM and asm coverage of a Hack program")
+    p.add_argument("file", help="Path to .asm file, translated without --strip")
+    p.add_argument("--max-steps", type=int, default=10_000_000, help="Stop after this many instructions")
+    p.add_argument("--missed", action="store_true", help="List functions and commands that never ran")
+    args = p.parse_args()
+
+    with open(args.file) as fh:
+        hack_program = fh.read()
+
+    cov = Coverage(hack_program)
+    cov.run(max_steps=args.max_steps)
+
+    print(format_report(cov.report(), show_missed=args.missed))
@@ -0,0 +1,208 @@
+import argparse
+import struct
+import sys
+import zlib
+from array import array
+from typing import IO, Dict, Iterator, Optional
+
+from hackulator import Compy386
+
+# Trace file layout, all little-endian:
+#
+#   header:  magic, number of columns, then per column an 8-byte name
+#            and its array typecode
+#   chunks:  number of records, payload size, flags, then the payload:
+#            each column's values back to back, optionally zlib-compressed
+#
+# Every column in a chunk is a plain uint/int array, so a chunk loads
+# with one numpy.frombuffer per column.
+TRACE_MAGIC = b"HACKTRC1"
+TRACE_HEADER = struct.Struct("<8sI")
+COLUMN_HEADER = struct.Struct("<8sc")
+CHUNK_HEADER = struct.Struct("<IIB")
+CHUNK_COMPRESSED = 0x1
+
+# addr is -1 when the instruction didn't write to RAM
+COLUMNS = (
+    ("cycle", "Q"),
+    ("pc", "H"),
+    ("a", "H"),
+    ("d", "H"),
+    ("addr", "i"),
+    ("value", "H"),
+)
+
+NUMPY_DTYPES = {"Q": "<u8", "H": "<u2", "i": "<i4"}
+
+
+class TraceWriter:
+    """
+    Buffers trace records column by column and writes them out in
+    fixed-size chunks, so memory use doesn't grow with the run.
+    """
+
+    def __init__(self, fh: IO[bytes], chunk_size: int = 65536, compress: bool = False):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+        self.num_records = 0
+
+        fh.write(TRACE_HEADER.pack(TRACE_MAGIC, len(COLUMNS)))
+        for name, typecode in COLUMNS:
+            assert array(typecode).itemsize == struct.calcsize("<" + typecode)
+            fh.write(COLUMN_HEADER.pack(name.encode(), typecode.encode()))
+
+    def flush(self):
+        count = len(self.columns["cycle"])
+        if not count:
+            return
+
+        parts = []
+        for name, typecode in COLUMNS:
+            column = self.columns[name]
+            if sys.byteorder == "big":
+                column.byteswap()
+            parts.append(column.tobytes())
+            del column[:]
+
+        payload = b"".join(parts)
+        if self.compress:
+            payload = zlib.compress(payload)
+
+        self.fh.write(CHUNK_HEADER.pack(count, len(payload), CHUNK_COMPRESSED if self.compress else 0))
+        self.fh.write(payload)
+        self.num_records += count
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+    def __enter__(self) -> "TraceWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_traced(compy: Compy386, writer: TraceWriter, max_steps: int = 1000):
+    """
+    Like Compy386.run, but record (cycle, pc, A, D, written address,
+    written value) for every instruction. A and D are the values after
+    the instruction ran.
+    """
+    instructions = compy.parsed_instructions
+    num_instructions = len(instructions)
+    chunk_size = writer.chunk_size
+
+    cycles = writer.columns["cycle"]
+    pcs = writer.columns["pc"]
+    a_values = writer.columns["a"]
+    d_values = writer.columns["d"]
+    addrs = writer.columns["addr"]
+    values = writer.columns["value"]
+
+    for s in range(max_steps):
+        pc = compy.pc
+        if pc >= num_instructions:
+            break
+
+        inst = instructions[pc]
+        addr = compy.register_a if inst[0] == "C" and inst[1] is not None and "M" in inst[1] else -1
+
+        compy.step()
+
+        cycles.append(compy.cycles)
+        pcs.append(pc)
+        a_values.append(compy.register_a)
+        d_values.append(compy.register_d)
+        addrs.append(addr)
+        values.append(compy.ram[addr] if addr >= 0 else 0)
+
+        if len(pcs) >= chunk_size:
+            writer.flush()
+
+    writer.flush()
+
+
+def iter_chunks(path: str) -> Iterator[Dict[str, array]]:
+    """
+    Read a trace one chunk at a time, as a dict of column arrays.
+    """
+    with open(path, "rb") as fh:
+        magic, num_columns = TRACE_HEADER.unpack(fh.read(TRACE_HEADER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a trace file")
+
+        columns = []
+        for ii in range(num_columns):
+            name, typecode = COLUMN_HEADER.unpack(fh.read(COLUMN_HEADER.size))
+            columns.append((name.rstrip(b"\0").decode(), typecode.decode()))
+
+        while header := fh.read(CHUNK_HEADER.size):
+            count, size, flags = CHUNK_HEADER.unpack(header)
+            payload = fh.read(size)
+            if flags & CHUNK_COMPRESSED:
+                payload = zlib.decompress(payload)
+
+            chunk = {}
+            offset = 0
+            for name, typecode in columns:
+                column = array(typecode)
+                column.frombytes(payload[offset:offset + count * column.itemsize])
+                if sys.byteorder == "big":
+                    column.byteswap()
+                offset += count * column.itemsize
+                chunk[name] = column
+            yield chunk
+
+
+def load_trace(path: str, use_numpy: Optional[bool] = None) -> dict:
+    """
+    Load a whole trace as one array per column.
+
+    Args:
+        use_numpy: return numpy arrays. The default is to use numpy if
+            it can be imported, and array.array otherwise.
+    """
+    if use_numpy is None:
+        try:
+            import numpy
+            use_numpy = True
+        except ImportError:
+            use_numpy = False
+
+    if use_numpy:
+        import numpy as np
+        chunks = list(iter_chunks(path))
+        return {
+            name: np.concatenate([np.frombuffer(chunk[name], dtype=NUMPY_DTYPES[typecode]) for chunk in chunks])
+            if chunks else np.zeros(0, dtype=NUMPY_DTYPES[typecode])
+            for name, typecode in COLUMNS
+        }
+
+    out = {name: array(typecode) for name, typecode in COLUMNS}
+    for chunk in iter_chunks(path):
+        for name, column in chunk.items():
+            out[name].extend(column)
+    return out
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser("hack_trace", description="Record a full execution trace of a Hack program")
+    p.add_argument("file", help="Path to file with hack source code")
+    p.add_argument("output", help="Path of the trace file to write")
+    p.add_argument("--max-steps", type=int, default=1_000_000, help="Stop after this many instructions")
+    p.add_argument("--chunk-size", type=int, default=65536, help="Records per chunk")
+    p.add_argument("--compress", action="store_true", help="zlib-compress each chunk")
+    args = p.parse_args()
+
+    with open(args.file) as fh:
+        hack_program = fh.read()
+
+    compy = Compy386(hack_program)
+
+    with TraceWriter(open(args.output, "wb"), args.chunk_size, args.compress) as writer:
+        run_traced(compy, writer, max_steps=args.max_steps)
+
+    print(f"Wrote {writer.num_records} records to {args.output}")
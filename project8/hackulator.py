@@ -1,6 +1,10 @@
 import argparse
+import collections
+import struct
 import sys
-from typing import Literal, NamedTuple, Sequence
+import zlib
+from array import array
+from typing import IO, Callable, Iterable, Literal, Mapping, NamedTuple, Sequence
 import dataclasses
 
 # Commands:
@@ -99,10 +103,112 @@ def init_symbol_table() -> dict[str, int]:
     return symbol_table
 
 
+# Machine code for the comp part of a C-instruction: the a-bit followed by
+# c1...c6. Instructions are 111a cccc ccdd djjj.
+COMP_BITS: dict[str, int] = {
+    "0":   0b0101010,
+    "1":   0b0111111,
+    "-1":  0b0111010,
+    "D":   0b0001100,
+    "A":   0b0110000,
+    "!D":  0b0001101,
+    "!A":  0b0110001,
+    "-D":  0b0001111,
+    "-A":  0b0110011,
+    "D+1": 0b0011111,
+    "A+1": 0b0110111,
+    "D-1": 0b0001110,
+    "A-1": 0b0110010,
+    "D+A": 0b0000010,
+    "D-A": 0b0010011,
+    "A-D": 0b0000111,
+    "D&A": 0b0000000,
+    "D|A": 0b0010101,
+    "M":   0b1110000,
+    "!M":  0b1110001,
+    "-M":  0b1110011,
+    "M+1": 0b1110111,
+    "M-1": 0b1110010,
+    "D+M": 0b1000010,
+    "D-M": 0b1010011,
+    "M-D": 0b1000111,
+    "D&M": 0b1000000,
+    "D|M": 0b1010101,
+}
+
+# Canonical spelling for each comp, used when decoding.
+COMP_FROM_BITS: dict[int, str] = {bits: comp for comp, bits in COMP_BITS.items()}
+
+# Operands of +, & and | can go either way around.
+for _comp in ("D+A", "D&A", "D|A", "D+M", "D&M", "D|M"):
+    COMP_BITS[_comp[::-1]] = COMP_BITS[_comp]
+
+DEST_NAMES = (None, "M", "D", "MD", "A", "AM", "AD", "AMD")
+JUMP_NAMES = (None, "JGT", "JEQ", "JGE", "JLT", "JNE", "JLE", "JMP")
+JUMP_BITS: dict[str | None, int] = {jump: ii for ii, jump in enumerate(JUMP_NAMES)}
+
+
+def encode_dest(dest: str | None) -> int:
+    if dest is None:
+        return 0
+    return (4 if "A" in dest else 0) | (2 if "D" in dest else 0) | (1 if "M" in dest else 0)
+
+
+def encode_instruction(instruction: tuple) -> int:
+    """
+    Encode a parsed instruction, with symbols resolved, as a 16-bit word.
+
+    >>> encode_instruction(("A", 21, ""))
+    21
+    >>> f"{encode_instruction(('C', 'AM', 'M-1', None, '')):016b}"
+    '1111110010101000'
+    """
+    if instruction[0] == "A":
+        addr = instruction[1]
+        if not 0 <= addr < 0x8000:
+            raise ValueError(f"Address {addr} does not fit in an A-instruction")
+        return addr
+
+    dest, comp, jump = instruction[1:4]
+    try:
+        comp_bits = COMP_BITS[comp]
+    except KeyError:
+        raise ValueError(f"Unsupported command '{comp}'") from None
+
+    return 0xE000 | (comp_bits << 6) | (encode_dest(dest) << 3) | JUMP_BITS[jump]
+
+
+def decode_instruction(word: int) -> tuple:
+    """
+    Turn a 16-bit word back into a parsed instruction with no comment.
+
+    >>> decode_instruction(0b1111110010101000)
+    ('C', 'AM', 'M-1', None, '')
+    """
+    if word < 0x8000:
+        return ("A", word, "")
+    return ("C", DEST_NAMES[(word >> 3) & 7], COMP_FROM_BITS[(word >> 6) & 0x7F], JUMP_NAMES[word & 7], "")
+
+
+def decode_program(words: Iterable[int]) -> list[tuple]:
+    """
+    Decode machine code for Compy386. Repeated words share one tuple.
+    """
+    decoded: dict[int, tuple] = {}
+    out = []
+    for word in words:
+        inst = decoded.get(word)
+        if inst is None:
+            inst = decoded[word] = decode_instruction(word)
+        out.append(inst)
+    return out
+
+
 @dataclasses.dataclass
 class Parser:
     symbol_table: dict[str, int] = dataclasses.field(default_factory=dict)
     parsed_instructions: list[tuple[str, ...]] = dataclasses.field(default_factory=list)
+    source_lines: list[int] = dataclasses.field(default_factory=list)
 
     def __post_init__(self):
         self.symbol_table = init_symbol_table()
@@ -114,12 +220,16 @@ class Parser:
         """
         Parse raw lines of assembly, add to symbol table, and store
         parsed instructions with all symbols resolved.
+
+        The index of the source line of each instruction is kept in
+        source_lines, so source_lines[pc] is the line that produced pc.
         """
         # First pass: add labels to symbol table
 
         insts = []
+        self.source_lines = []
 
-        for line in lines:
+        for line_number, line in enumerate(lines):
             parsed = parse_instruction(line)
             if parsed is None:
                 continue
@@ -133,6 +243,7 @@ class Parser:
                 self.symbol_table[parsed[1]] = cur_line_number
             else:
                 insts.append(parsed)
+                self.source_lines.append(line_number)
 
         # Second pass: put other variables in symbol table and
         # replace them with ints in the instructions
@@ -164,6 +275,56 @@ class Parser:
                 assert len(instruction) == 5
                 self.parsed_instructions.append(instruction)
 
+    def parse_stream(self, fh: IO[str]) -> array:
+        """
+        Assemble a program from a seekable file handle, one line at a time.
+
+        The first pass only records label positions. The second pass
+        resolves symbols and encodes each instruction straight into a
+        16-bit word, so neither the source text nor the parsed tuples are
+        kept. parsed_instructions and source_lines are left empty.
+
+        Returns:
+            array of machine words, one per instruction
+        """
+        # First pass: add labels to symbol table
+
+        start = fh.tell()
+        num_instructions = 0
+
+        for line in fh:
+            parsed = parse_instruction(line)
+            if parsed is None:
+                continue
+            if parsed[0] == "L":
+                self.symbol_table[parsed[1]] = num_instructions
+            else:
+                num_instructions += 1
+
+        # Second pass: resolve variables and encode
+
+        fh.seek(start)
+        idx_next_symbol = 16
+        words = array("H")
+
+        for line in fh:
+            parsed = parse_instruction(line)
+            if parsed is None or parsed[0] == "L":
+                continue
+
+            if parsed[0] == "A" and isinstance(parsed[1], str):
+                addr = self.symbol_table.get(parsed[1])
+                if addr is None:
+                    addr = self.symbol_table[parsed[1]] = idx_next_symbol
+                    idx_next_symbol += 1
+                parsed = ("A", addr, "")
+
+            words.append(encode_instruction(parsed))
+
+        self.parsed_instructions = []
+        self.source_lines = []
+        return words
+
 def parse(program: Sequence[str]) -> list[tuple[str,...]]:
     """
     Parse a Hack assembly program and return parsed instructions.
@@ -237,6 +398,132 @@ def compute(comp: str, dd: int, aa: int, mm: int) -> int:
     return tmp
 
 
+# RAM image file: header, then the RAM as little-endian uint16, optionally
+# zlib-compressed. Header fields are magic, flags, A, D, pc, cycles and
+# the number of RAM words.
+IMAGE_MAGIC = b"HACKRAM1"
+IMAGE_HEADER = struct.Struct("<8sHHHIQI")
+IMAGE_COMPRESSED = 0x1
+
+
+class MachineImage(NamedTuple):
+    register_a: int
+    register_d: int
+    pc: int
+    cycles: int
+    ram: array
+
+
+def write_image(path: str, image: MachineImage, compress: bool = False):
+    """
+    Save machine state to a RAM image file.
+    """
+    ram = image.ram if isinstance(image.ram, array) else array("H", image.ram)
+    if sys.byteorder == "big":
+        ram = array("H", ram)
+        ram.byteswap()
+
+    payload = zlib.compress(ram.tobytes()) if compress else ram
+    header = IMAGE_HEADER.pack(
+        IMAGE_MAGIC,
+        IMAGE_COMPRESSED if compress else 0,
+        image.register_a,
+        image.register_d,
+        image.pc,
+        image.cycles,
+        len(ram),
+    )
+
+    with open(path, "wb") as fh:
+        fh.write(header)
+        fh.write(payload)
+
+
+def read_image(path: str) -> MachineImage:
+    """
+    Load a RAM image file. Uncompressed RAM is read with a single
+    readinto, straight into the array.
+    """
+    with open(path, "rb") as fh:
+        magic, flags, register_a, register_d, pc, cycles, num_words = IMAGE_HEADER.unpack(fh.read(IMAGE_HEADER.size))
+        if magic != IMAGE_MAGIC:
+            raise ValueError(f"{path} is not a RAM image")
+
+        if flags & IMAGE_COMPRESSED:
+            ram = array("H", zlib.decompress(fh.read()))
+            num_read = len(ram)
+        else:
+            ram = array("H", bytes(2*num_words))
+            num_read = fh.readinto(ram) // 2
+
+    if num_read != num_words:
+        raise ValueError(f"{path} is truncated: expected {num_words} words, got {num_read}")
+    if sys.byteorder == "big":
+        ram.byteswap()
+
+    return MachineImage(register_a, register_d, pc, cycles, ram)
+
+
+# The device bus looks addresses up in a table of 256-word pages, so an
+# access to a page without devices costs one list index.
+PAGE_BITS = 8
+NUM_PAGES = 0x10000 >> PAGE_BITS
+
+
+@dataclasses.dataclass(frozen=True)
+class Device:
+    """
+    Handlers for the addresses start <= addr < end.
+
+    read(addr) returns the value seen by the CPU instead of RAM[addr].
+    write(addr, value) is called after the value is stored in RAM.
+    """
+    start: int
+    end: int
+    read: Callable[[int], int] | None = None
+    write: Callable[[int, int], None] | None = None
+
+
+class DeviceBus:
+    """
+    Memory-mapped I/O: routes accesses in registered address ranges to
+    device handlers.
+    """
+
+    def __init__(self):
+        self.devices: list[Device] = []
+        self.pages: list[tuple[Device, ...] | None] = [None]*NUM_PAGES
+
+    def register(self, device: Device) -> Device:
+        assert 0 <= device.start < device.end <= 0x10000, f"bad range {device.start}:{device.end}"
+        self.devices.append(device)
+        self._build_pages()
+        return device
+
+    def unregister(self, device: Device):
+        self.devices.remove(device)
+        self._build_pages()
+
+    def _build_pages(self):
+        self.pages = [None]*NUM_PAGES
+        for device in self.devices:
+            for page in range(device.start >> PAGE_BITS, ((device.end - 1) >> PAGE_BITS) + 1):
+                self.pages[page] = (self.pages[page] or ()) + (device,)
+
+    def read(self, page: tuple[Device, ...], addr: int, ram: list[int]) -> int:
+        for device in page:
+            if device.read is not None and device.start <= addr < device.end:
+                return device.read(addr)
+        return ram[addr] if addr < len(ram) else 0
+
+    def write(self, page: tuple[Device, ...], addr: int, value: int, ram: list[int]):
+        if addr < len(ram):
+            ram[addr] = value
+        for device in page:
+            if device.write is not None and device.start <= addr < device.end:
+                device.write(addr, value)
+
+
 class Compy386:
 
     def __init__(self, program: str = ""): #, init_sp: bool = True):
@@ -244,6 +531,9 @@ class Compy386:
         self.register_a: int = 0
         self.ram: list[int] = [0]*(2**15)
         self.pc: int = 0
+        self.cycles: int = 0
+        self.bus: DeviceBus | None = None
+        self.undo_log: collections.deque[tuple[int, ...]] | None = None
 
         # if init_sp:
             # program = self.init_memory_segments_mapping() + "\n" + program
@@ -252,10 +542,34 @@ class Compy386:
         parser.parse(program.splitlines())
         self.parsed_instructions: list[tuple[str,...]] = parser.parsed_instructions
         self.symbol_table = parser.symbol_table
+        self.source_lines: list[int] = parser.source_lines
 
         self.stack_ptr: int = 256 # address of bottom of stack
         self.sp = self.stack_ptr
 
+    @classmethod
+    def from_words(cls, words: Sequence[int], symbol_table: dict[str, int] | None = None) -> "Compy386":
+        """
+        Make a computer that runs machine code, e.g. from Parser.parse_stream.
+        """
+        return cls.from_parsed(decode_program(words), symbol_table)
+
+    @classmethod
+    def from_parsed(cls, parsed_instructions: Sequence[tuple[str, ...]], symbol_table: Mapping[str, int] | None = None) -> "Compy386":
+        """
+        Make a computer that runs already parsed instructions.
+
+        The instructions and symbol table are used as they are, not
+        copied, so one read-only program (e.g. a tuple) can be shared by
+        computers running on different threads. Each computer has its
+        own RAM and registers.
+        """
+        compy = cls()
+        compy.parsed_instructions = parsed_instructions  # type: ignore
+        if symbol_table is not None:
+            compy.symbol_table = symbol_table  # type: ignore
+        return compy
+
     @classmethod
     def init_memory_segments_mapping(cls) -> str:
         """
@@ -293,7 +607,11 @@ class Compy386:
         if print_line:
             print(f"{self.pc}: {inst}")
 
+        if self.undo_log is not None:
+            self._record_undo(inst)
+
         self.pc += 1
+        self.cycles += 1
 
         if (opcode := inst[0]) == "A":
             addr = inst[1]
@@ -303,7 +621,12 @@ class Compy386:
             assert opcode == "C"
             dest, comp, jump, comment = inst[1:]
 
-            if 0 <= self.register_a < len(self.ram):
+            # Only memory-mapped pages go through the device bus
+            page = self.bus.pages[self.register_a >> PAGE_BITS] if self.bus is not None else None
+
+            if page is not None and "M" in comp:
+                register_m = self.bus.read(page, self.register_a, self.ram)
+            elif 0 <= self.register_a < len(self.ram):
                 register_m = self.ram[self.register_a]
             else:
                 register_m = 0
@@ -314,7 +637,10 @@ class Compy386:
             else:
                 # careful: must write M before A
                 if "M" in dest:
-                    self.ram[self.register_a] = result
+                    if page is not None:
+                        self.bus.write(page, self.register_a, result, self.ram)
+                    else:
+                        self.ram[self.register_a] = result
                 if "A" in dest:
                     self.register_a = result
                 if "D" in dest:
@@ -338,6 +664,92 @@ class Compy386:
         if print_stack:
             print("  ", self.get_stack())
 
+    def enable_undo(self, max_steps: int = 1_000_000):
+        """
+        Start recording enough to undo each instruction, keeping the
+        last max_steps instructions.
+        """
+        self.undo_log = collections.deque(maxlen=max_steps)
+
+    def disable_undo(self):
+        self.undo_log = None
+
+    def _record_undo(self, inst: tuple[str, ...]):
+        """
+        Save pc, A and D, plus the address and old value of the RAM word
+        the instruction is about to overwrite, if any.
+        """
+        assert self.undo_log is not None
+        if inst[0] == "C" and inst[1] is not None and "M" in inst[1] and self.register_a < len(self.ram):
+            self.undo_log.append((self.pc, self.register_a, self.register_d, self.register_a, self.ram[self.register_a]))
+        else:
+            self.undo_log.append((self.pc, self.register_a, self.register_d))
+
+    def step_back(self, num_steps: int = 1) -> int:
+        """
+        Undo the last num_steps instructions, or as many as the undo log
+        holds. Device handlers are not told about restored RAM words.
+
+        Returns:
+            number of instructions undone
+        """
+        assert self.undo_log is not None, "call enable_undo() first"
+
+        num_undone = 0
+        while num_undone < num_steps and self.undo_log:
+            entry = self.undo_log.pop()
+            self.pc, self.register_a, self.register_d = entry[:3]
+            if len(entry) == 5:
+                self.ram[entry[3]] = entry[4]
+            num_undone += 1
+
+        self.cycles -= num_undone
+        return num_undone
+
+    def save_image(self, path: str, compress: bool = False):
+        """
+        Save RAM, A, D, pc and the cycle count to a RAM image file.
+        RAM words must be 16-bit unsigned values.
+        """
+        write_image(path, MachineImage(self.register_a, self.register_d, self.pc, self.cycles, array("H", self.ram)), compress)
+
+    def load_image(self, path: str):
+        """
+        Restore state saved with save_image.
+        """
+        image = read_image(path)
+        if len(image.ram) != len(self.ram):
+            raise ValueError(f"Image has {len(image.ram)} words of RAM, expected {len(self.ram)}")
+
+        self.ram[:] = image.ram
+        self.register_a = image.register_a
+        self.register_d = image.register_d
+        self.pc = image.pc
+        self.cycles = image.cycles
+
+    def attach_device(
+        self,
+        start: int,
+        end: int,
+        read: Callable[[int], int] | None = None,
+        write: Callable[[int, int], None] | None = None,
+    ) -> Device:
+        """
+        Map a device into memory at start <= addr < end, e.g.
+        attach_device(KBD, KBD + 1, read=lambda addr: key).
+
+        Programs that never attach a device don't pay for the bus.
+        """
+        if self.bus is None:
+            self.bus = DeviceBus()
+        return self.bus.register(Device(start, end, read, write))
+
+    def detach_device(self, device: Device):
+        assert self.bus is not None
+        self.bus.unregister(device)
+        if not self.bus.devices:
+            self.bus = None
+
     def set_segment_base(self, segment: Literal["SP", "LCL", "ARG", "THIS", "THAT"], base_addr: int):
         assert segment in ("SP", "LCL", "ARG", "THIS", "THAT")
         self.ram[self.symbol_table[segment]] = base_addr
@@ -480,22 +892,36 @@ class Compy386:
 if __name__ == "__main__":
     p = argparse.ArgumentParser("hackulator", description="Hack program emulator")
     p.add_argument("file", action="store", help="Path to file with hack source code")
+    p.add_argument("--stream", action="store_true", help="Assemble line by line without keeping the source in memory")
+    p.add_argument("--load-image", help="Start from the machine state in this RAM image")
+    p.add_argument("--save-image", help="Save the final machine state to this RAM image")
     args = p.parse_args()
 
-    with open(args.file) as fh:
-        hack_program = fh.read()
-
     # Execute the program
 
-    compy = Compy386(hack_program)
+    if args.stream:
+        parser = Parser()
+        with open(args.file) as fh:
+            compy = Compy386.from_words(parser.parse_stream(fh), parser.symbol_table)
+    else:
+        with open(args.file) as fh:
+            hack_program = fh.read()
+        compy = Compy386(hack_program)
+
     compy.stack_ptr = 256
     compy.set_segment_base("LCL", 300)
     compy.set_segment_base("ARG", 400)
     compy.set_segment_base("THIS", 3000)
     compy.set_segment_base("THAT", 3010)
 
+    if args.load_image:
+        compy.load_image(args.load_image)
+
     compy.run(max_steps=191, print_line=False, print_registers=False)
 
+    if args.save_image:
+        compy.save_image(args.save_image)
+
     print("DONE")
 
     idx_test = [256, 300, 401, 402, 3006, 3012, 3015, 11]
@@ -0,0 +1,206 @@
+import argparse
+import dataclasses
+import importlib.util
+from pathlib import Path
+from typing import Callable, Optional, Protocol, Set, Tuple, Type
+
+
+class Engine(Protocol):
+    """
+    What the lockstep harness needs from an emulator. Compy386 from
+    project7 and project8 both qualify.
+    """
+    pc: int
+    register_a: int
+    register_d: int
+    ram: list[int]
+    parsed_instructions: list[tuple[str, ...]]
+
+    def step(self) -> None: ...
+
+
+@dataclasses.dataclass
+class Divergence:
+    """
+    First point where two engines disagree.
+
+    cycle counts executed instructions, so cycle 1 is the state right
+    after the first instruction. pc is the instruction that was run to
+    get there, according to the first engine.
+    """
+    cycle: int
+    pc: int
+    what: str
+    value_a: int
+    value_b: int
+
+    def __str__(self) -> str:
+        return (f"cycle {self.cycle} (after pc {self.pc}): "
+                f"{self.what} differs: {self.value_a} != {self.value_b}")
+
+
+def written_address(engine: Engine) -> Optional[int]:
+    """
+    Address the next instruction will write to, or None if it doesn't
+    write to RAM.
+    """
+    inst = engine.parsed_instructions[engine.pc]
+    if inst[0] == "C" and inst[1] is not None and "M" in inst[1]:
+        return engine.register_a
+    return None
+
+
+def is_halted(engine: Engine) -> bool:
+    return engine.pc >= len(engine.parsed_instructions)
+
+
+def compare(a: Engine, b: Engine, addresses: Set[int]) -> Optional[Tuple[str, int, int]]:
+    """
+    Compare registers and the given RAM words.
+
+    Returns:
+        (what, value_a, value_b) for the first difference, or None
+    """
+    if a.pc != b.pc:
+        return ("pc", a.pc, b.pc)
+    if a.register_a != b.register_a:
+        return ("A", a.register_a, b.register_a)
+    if a.register_d != b.register_d:
+        return ("D", a.register_d, b.register_d)
+
+    ram_a, ram_b = a.ram, b.ram
+    for addr in sorted(addresses):
+        if ram_a[addr] != ram_b[addr]:
+            return (f"RAM[{addr}]", ram_a[addr], ram_b[addr])
+    return None
+
+
+def run_lockstep(
+    make_a: Callable[[], Engine],
+    make_b: Callable[[], Engine],
+    max_steps: int = 1000,
+    batch_size: int = 1,
+) -> Optional[Divergence]:
+    """
+    Run two engines on the same program and find the first cycle where
+    pc, A, D or a written RAM word differs.
+
+    Each step only the addresses written by either engine are collected,
+    and they are compared every batch_size steps. When a batch shows a
+    difference, fresh engines are run up to the start of that batch and
+    the batch is replayed one step at a time to find the exact cycle.
+
+    Args:
+        make_a, make_b: build an engine with its initial state set up.
+            They're called again if a batch has to be replayed.
+        max_steps: stop after this many instructions
+        batch_size: compare every this many instructions
+    Returns:
+        the first Divergence, or None if the engines agree throughout
+    """
+    a, b = make_a(), make_b()
+
+    # Anything set up before the run has to match too.
+    if a.ram != b.ram:
+        addr = next(ii for ii, (x, y) in enumerate(zip(a.ram, b.ram)) if x != y)
+        return Divergence(0, a.pc, f"RAM[{addr}]", a.ram[addr], b.ram[addr])
+    if (diff := compare(a, b, set())) is not None:
+        return Divergence(0, a.pc, *diff)
+
+    cycle = 0
+    while cycle < max_steps and not (is_halted(a) and is_halted(b)):
+        batch_start = cycle
+        written: Set[int] = set()
+
+        for s in range(min(batch_size, max_steps - cycle)):
+            if is_halted(a) or is_halted(b):
+                break
+            if (addr := written_address(a)) is not None:
+                written.add(addr)
+            if (addr := written_address(b)) is not None:
+                written.add(addr)
+            a.step()
+            b.step()
+            cycle += 1
+
+        if compare(a, b, written) is not None or is_halted(a) != is_halted(b):
+            return _replay_batch(make_a, make_b, batch_start, cycle)
+
+    return None
+
+
+def _replay_batch(
+    make_a: Callable[[], Engine],
+    make_b: Callable[[], Engine],
+    batch_start: int,
+    batch_end: int,
+) -> Optional[Divergence]:
+    """
+    Rerun both engines to batch_start, then compare after every step.
+    """
+    a, b = make_a(), make_b()
+    for s in range(batch_start):
+        a.step()
+        b.step()
+
+    for cycle in range(batch_start + 1, batch_end + 2):
+        if is_halted(a) or is_halted(b):
+            if is_halted(a) != is_halted(b):
+                return Divergence(cycle - 1, a.pc, "pc", a.pc, b.pc)
+            break
+
+        written = {addr for addr in (written_address(a), written_address(b)) if addr is not None}
+        pc = a.pc
+        a.step()
+        b.step()
+
+        if (diff := compare(a, b, written)) is not None:
+            return Divergence(cycle, pc, *diff)
+
+    return None
+
+
+def load_engine(path: str, class_name: str = "Compy386") -> Type[Engine]:
+    """
+    Import an emulator class from a file, e.g. project7/hackulator.py.
+
+    The module gets a name derived from its path, so two files that are
+    both called hackulator.py can be loaded side by side.
+    """
+    path_obj = Path(path).resolve()
+    module_name = "lockstep_" + "_".join(path_obj.with_suffix("").parts[-2:]).replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, path_obj)
+    assert spec is not None and spec.loader is not None, f"cannot import {path}"
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
+
+
+if __name__ == "__main__":
+    here = Path(__file__).parent
+
+    p = argparse.ArgumentParser("lockstep", description="Run two Hack emulators side by side and report where they diverge")
+    p.add_argument("file", help="Path to file with hack source code")
+    p.add_argument("--engine-a", default=str(here.parent / "project7" / "hackulator.py"), help="File with the first Compy386")
+    p.add_argument("--engine-b", default=str(here / "hackulator.py"), help="File with the second Compy386")
+    p.add_argument("--max-steps", type=int, default=1_000_000, help="Stop after this many instructions")
+    p.add_argument("--batch", type=int, default=1000, help="Compare every this many instructions")
+    args = p.parse_args()
+
+    with open(args.file) as fh:
+        hack_program = fh.read()
+
+    engine_a = load_engine(args.engine_a)
+    engine_b = load_engine(args.engine_b)
+
+    divergence = run_lockstep(
+        lambda: engine_a(hack_program),
+        lambda: engine_b(hack_program),
+        max_steps=args.max_steps,
+        batch_size=args.batch,
+    )
+
+    if divergence is None:
+        print(f"No divergence in {args.max_steps} steps")
+    else:
+        print(divergence)
@@ -0,0 +1,271 @@
+import argparse
+from typing import Callable, List, Optional, Sequence
+
+# Peephole optimizer for Hack assembly.
+#
+# Every rewrite leaves pc-independent machine state (RAM, A, D) exactly
+# as the original code would, so it is safe on any .asm file as long as
+# nothing jumps into the middle of a rewritten sequence. Jump targets
+# are labels, and labels end the straight-line runs the rules look at.
+# Reads and writes are assumed to hit plain RAM (no device side effects).
+
+
+class _Line:
+    """
+    A line of assembly; command is the instruction or label without the
+    comment, or "" for blank and comment-only lines.
+    """
+    __slots__ = ("text", "command")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.command = text.split("//", 1)[0].strip()
+
+    def set(self, command: str):
+        self.text = command
+        self.command = command
+
+    def delete(self):
+        self.text = None
+        self.command = ""
+
+
+def _is_label(command: str) -> bool:
+    return command.startswith("(")
+
+
+def _a_value(command: str) -> Optional[int]:
+    """
+    Numeric operand of an A-instruction, or None.
+    """
+    if command.startswith("@") and command[1:].isdigit():
+        return int(command[1:])
+    return None
+
+
+def _dest(command: str) -> str:
+    return command.split("=", 1)[0] if "=" in command else ""
+
+
+def _comp(command: str) -> str:
+    comp = command.split("=", 1)[-1]
+    return comp.split(";", 1)[0]
+
+
+def _instructions(lines: List[_Line]) -> List[_Line]:
+    return [line for line in lines if line.command]
+
+
+def _a_dead_after(insts: List[_Line], idx: int) -> bool:
+    """
+    True if the instruction after insts[idx] overwrites A without using it.
+    """
+    return idx + 1 < len(insts) and insts[idx + 1].command.startswith("@")
+
+
+PUSH_D = ["@SP", "A=M", "M=D", "@SP", "M=M+1"]
+POP_D = ["@SP", "AM=M-1", "D=M"]
+
+
+def fold_push_pop(lines: List[_Line]) -> bool:
+    """
+    Push D immediately followed by pop into D:
+
+        @SP, A=M, M=D, @SP, M=M+1, @SP, AM=M-1, D=M  =>  @SP, A=M, M=D
+
+    Both leave SP alone, D unchanged, the old top slot holding D and A
+    pointing at it.
+    """
+    insts = _instructions(lines)
+    pattern = PUSH_D + POP_D
+    changed = False
+
+    ii = 0
+    while ii + len(pattern) <= len(insts):
+        if [line.command for line in insts[ii:ii + len(pattern)]] == pattern:
+            for line in insts[ii + 3:ii + len(pattern)]:
+                line.delete()
+            changed = True
+            ii += len(pattern)
+        else:
+            ii += 1
+    return changed
+
+
+def drop_redundant_loads(lines: List[_Line]) -> bool:
+    """
+    Track what A and D hold across straight-line code, and remove
+
+        @X   when A already holds X
+        D=M  when M is known to equal D
+        M=D  when M is known to equal D
+    """
+    changed = False
+    a_symbol: Optional[str] = None
+    m_equals_d = False
+
+    for line in lines:
+        command = line.command
+        if not command:
+            continue
+
+        if _is_label(command):
+            a_symbol = None
+            m_equals_d = False
+            continue
+
+        if command.startswith("@"):
+            if command == a_symbol:
+                line.delete()
+                changed = True
+                continue
+            a_symbol = command
+            m_equals_d = False
+            continue
+
+        dest, comp = _dest(command), _comp(command)
+
+        if m_equals_d and ";" not in command and (command == "D=M" or command == "M=D"):
+            line.delete()
+            changed = True
+            continue
+
+        if "A" in dest:
+            a_symbol = None
+            m_equals_d = False
+        elif "M" in dest and "D" in dest:
+            m_equals_d = True
+        elif dest == "M":
+            m_equals_d = comp == "D"
+        elif dest == "D":
+            m_equals_d = comp == "M"
+
+    return changed
+
+
+# Adjacent updates of the same word that cancel out
+CANCELLING = {
+    ("M=M+1", "M=M-1"): [],
+    ("M=M-1", "M=M+1"): [],
+    ("M=M+1", "AM=M-1"): ["A=M"],
+    ("M=M-1", "AM=M+1"): ["A=M"],
+}
+
+
+def cancel_increments(lines: List[_Line]) -> bool:
+    """
+    Remove M=M+1 followed by M=M-1 on the same address (e.g. SP when a
+    push is followed by a pop), or fold M=M+1, AM=M-1 into A=M.
+    """
+    insts = _instructions(lines)
+    changed = False
+
+    for first, second in zip(insts, insts[1:]):
+        if not first.command or not second.command:
+            continue
+        replacement = CANCELLING.get((first.command, second.command))
+        if replacement is None:
+            continue
+        first.delete()
+        if replacement:
+            second.set(replacement[0])
+        else:
+            second.delete()
+        changed = True
+
+    return changed
+
+
+def fold_constants(lines: List[_Line]) -> bool:
+    """
+    Fold constant arithmetic when A isn't used afterwards:
+
+        @X, D=A,   @Y, D=D+A  =>  @X+Y, D=A
+        @X, D=A,   @Y, D=D-A  =>  @X-Y, D=A
+        @X, D=D+A, @Y, D=D+A  =>  @X+Y, D=D+A
+        @X, D=D-A, @Y, D=D-A  =>  @X+Y, D=D-A
+    """
+    insts = _instructions(lines)
+    changed = False
+
+    ii = 0
+    while ii + 4 <= len(insts):
+        at_x, op1, at_y, op2 = (line.command for line in insts[ii:ii + 4])
+        x, y = _a_value(at_x), _a_value(at_y)
+
+        folded = None
+        if x is not None and y is not None and _a_dead_after(insts, ii + 3):
+            if op1 == "D=A" and op2 in ("D=D+A", "D=A+D"):
+                folded = (x + y, "D=A")
+            elif op1 == "D=A" and op2 == "D=D-A":
+                folded = (x - y, "D=A")
+            elif op1 in ("D=D+A", "D=A+D") and op2 in ("D=D+A", "D=A+D"):
+                folded = (x + y, "D=D+A")
+            elif op1 == "D=D-A" and op2 == "D=D-A":
+                folded = (x + y, "D=D-A")
+
+        if folded is not None and 0 <= folded[0] < 0x8000:
+            insts[ii].set(f"@{folded[0]}")
+            insts[ii + 1].set(folded[1])
+            insts[ii + 2].delete()
+            insts[ii + 3].delete()
+            insts[ii + 2:ii + 4] = []
+            changed = True
+        else:
+            ii += 1
+
+    return changed
+
+
+RULES: List[Callable[[List[_Line]], bool]] = [
+    fold_push_pop,
+    drop_redundant_loads,
+    cancel_increments,
+    fold_constants,
+]
+
+
+def optimize(lines: Sequence[str], max_rounds: int = 10) -> List[str]:
+    """
+    Optimize lines of Hack assembly. Comments on untouched lines are kept.
+    """
+    parsed = [_Line(line) for line in lines]
+
+    for _ in range(max_rounds):
+        changed = False
+        for rule in RULES:
+            if rule(parsed):
+                changed = True
+                parsed = [line for line in parsed if line.text is not None]
+        if not changed:
+            break
+
+    return [line.text for line in parsed]
+
+
+def optimize_program(program: str) -> str:
+    return "\n".join(optimize(program.splitlines()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Peephole-optimize a Hack .asm file."
+    )
+    parser.add_argument(
+        "input_file",
+        help="Hack .asm file"
+    )
+    parser.add_argument(
+        "output_file",
+        nargs="?",
+        help="Optional output path; default overwrites the input"
+    )
+    args = parser.parse_args()
+
+    with open(args.input_file) as fh:
+        program = fh.read()
+
+    optimized = optimize_program(program)
+
+    with open(args.output_file or args.input_file, "w") as fh:
+        fh.write(optimized)
@@ -0,0 +1,130 @@
+import argparse
+import functools
+import re
+from pathlib import Path
+from typing import Dict, List, MutableSequence, Sequence, Tuple
+
+from hackulator import init_symbol_table
+
+OUTPUT_JACK = Path(__file__).parent.parent / "project12-OS" / "code" / "Output.jack"
+
+# Character grid of the Output library: 23 rows of 64 characters, each
+# 8 pixels wide and 11 pixels high. A screen row is 32 words.
+NUM_ROWS = 23
+NUM_COLS = 64
+GLYPH_HEIGHT = 11
+WORDS_PER_LINE = 32
+
+# Output.getMap shows non-printable characters as a black square (map 0),
+# and cells that don't match any glyph decode as UNKNOWN.
+BLACK_SQUARE = "■"
+UNKNOWN = "�"
+
+Glyph = Tuple[int, ...]
+
+_CREATE = re.compile(r"do\s+Output\.create\(([\d\s,]+)\)")
+
+
+def read_glyphs(path: Path = OUTPUT_JACK) -> Dict[int, Glyph]:
+    """
+    Read the character bitmaps that Output.initMap installs.
+
+    Returns:
+        character code => 11 rows of pixels, least significant bit leftmost
+    """
+    glyphs = {}
+    for match in _CREATE.finditer(path.read_text()):
+        index, *rows = (int(num) for num in match.group(1).split(","))
+        assert len(rows) == GLYPH_HEIGHT, f"bad glyph {match.group(0)}"
+        glyphs[index] = tuple(rows)
+    return glyphs
+
+
+class ScreenDecoder:
+    """
+    Reads the text printed by Output.printChar back off the screen.
+
+    Each cell's 11 bytes are looked up in a dict of glyph bitmaps, so
+    decoding the screen is one hash lookup per character.
+    """
+
+    def __init__(self, glyphs: Dict[int, Glyph]):
+        self.glyphs = glyphs
+        self.chars: Dict[Glyph, str] = {}
+        for index in sorted(glyphs):
+            char = BLACK_SQUARE if index == 0 else chr(index)
+            self.chars.setdefault(glyphs[index], char)
+
+    @classmethod
+    def from_output_jack(cls, path: Path = OUTPUT_JACK) -> "ScreenDecoder":
+        return cls(read_glyphs(path))
+
+    def cell(self, ram: Sequence[int], row: int, col: int, base: int) -> str:
+        """
+        Decode the character at (row, col). Even columns are in the low
+        byte of each word and odd columns in the high byte.
+        """
+        addr = base + row*GLYPH_HEIGHT*WORDS_PER_LINE + col//2
+        shift = 8 if col & 1 else 0
+        glyph = tuple((ram[addr + ii*WORDS_PER_LINE] >> shift) & 0xFF for ii in range(GLYPH_HEIGHT))
+        return self.chars.get(glyph, UNKNOWN)
+
+    def lines(self, ram: Sequence[int], base: int | None = None) -> List[str]:
+        """
+        All 23 rows of 64 characters.
+        """
+        if base is None:
+            base = init_symbol_table()["SCREEN"]
+        return ["".join(self.cell(ram, row, col, base) for col in range(NUM_COLS)) for row in range(NUM_ROWS)]
+
+    def text(self, ram: Sequence[int], base: int | None = None) -> str:
+        """
+        The screen as a string, without trailing spaces or blank lines.
+        """
+        return "\n".join(line.rstrip() for line in self.lines(ram, base)).rstrip("\n")
+
+    def print_text(self, ram: MutableSequence[int], text: str, row: int = 0, col: int = 0, base: int | None = None):
+        """
+        Draw text the way Output.printChar does, wrapping at the end of
+        a row. Handy for setting up screens in tests.
+        """
+        if base is None:
+            base = init_symbol_table()["SCREEN"]
+
+        for char in text:
+            glyph = self.glyphs.get(ord(char), self.glyphs[0])
+            addr = base + row*GLYPH_HEIGHT*WORDS_PER_LINE + col//2
+            shift, keep = (8, 0x00FF) if col & 1 else (0, 0xFF00)
+
+            for ii in range(GLYPH_HEIGHT):
+                word_addr = addr + ii*WORDS_PER_LINE
+                ram[word_addr] = (ram[word_addr] & keep) | (glyph[ii] << shift)
+
+            row, col = (row + 1, 0) if col == NUM_COLS - 1 else (row, col + 1)
+
+
+@functools.cache
+def default_decoder() -> ScreenDecoder:
+    return ScreenDecoder.from_output_jack()
+
+
+def screen_text(ram: Sequence[int], base: int | None = None) -> str:
+    """
+    Text on the screen, decoded with the glyphs from Output.jack.
+    """
+    return default_decoder().text(ram, base)
+
+
+if __name__ == "__main__":
+    from hackulator import Compy386
+
+    p = argparse.ArgumentParser("screen_text", description="Run a Hack program and print the text on its screen")
+    p.add_argument("file", help="Path to file with hack source code")
+    p.add_argument("--max-steps", type=int, default=10_000_000, help="Stop after this many instructions")
+    args = p.parse_args()
+
+    with open(args.file) as fh:
+        compy = Compy386(fh.read())
+
+    compy.run(max_steps=args.max_steps)
+    print(screen_text(compy.ram))
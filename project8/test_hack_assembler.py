@@ -0,0 +1,131 @@
+import pytest
+from HackAssembler import MachineCodeWriter, assemble, format_hack, format_source_map, format_symbols, pack_words, unpack_words
+from hackulator import Compy386, Parser, encode_instruction
+from VMTranslator import translate
+
+
+# Add.asm from the nand2tetris project 6 materials, and its Add.hack
+ADD = """
+// Computes R0 = 2 + 3  (R0 refers to RAM[0])
+
+@2
+D=A
+@3
+D=D+A
+@0
+M=D
+"""
+
+ADD_HACK = """0000000000000010
+1110110000010000
+0000000000000011
+1110000010010000
+0000000000000000
+1110001100001000
+"""
+
+
+def test_add():
+    assert format_hack(assemble(ADD.splitlines()).words) == ADD_HACK
+
+
+def test_symbols():
+    program = """
+    @i
+    M=1 // i = 1
+    (LOOP)
+    @i
+    D=M
+    @sum
+    M=D+M
+    @LOOP
+    0;JMP
+    (END)
+    """
+    assembled = assemble(program.splitlines())
+
+    assert assembled.labels == {"LOOP": 2, "END": 8}
+    assert assembled.variables == {"i": 16, "sum": 17}
+    assert format_symbols(assembled) == "label LOOP 2\nlabel END 8\nvariable i 16\nvariable sum 17\n"
+    assert assembled.words[6] == 2
+
+
+def test_source_map():
+    assembled = assemble(ADD.splitlines())
+    lines = ADD.splitlines()
+
+    assert [lines[ii] for ii in assembled.source_lines] == ["@2", "D=A", "@3", "D=D+A", "@0", "M=D"]
+    assert format_source_map(assembled).splitlines()[0] == str(lines.index("@2") + 1)
+
+
+def test_matches_parser():
+    """
+    Same machine code as encoding what the emulator's Parser produces.
+    """
+    hack = translate("""
+        function Foo.bar 2
+        push constant 7
+        pop local 1
+        push local 1
+        push static 3
+        lt
+        if-goto DONE
+        call Foo.bar 0
+        label DONE
+        return
+    """, "Foo")
+
+    parser = Parser()
+    parser.parse(hack.splitlines())
+    assembled = assemble(hack.splitlines())
+
+    assert list(assembled.words) == [encode_instruction(inst) for inst in parser.parsed_instructions]
+    assert assembled.source_lines == parser.source_lines
+
+
+def test_runs():
+    program = """
+    @R0
+    D=M
+    @R1
+    M=D+1
+    """
+    compy = Compy386.from_words(assemble(program.splitlines()).words)
+    compy.ram[0] = 41
+    compy.run()
+    assert compy.ram[1] == 42
+
+
+def test_bad_instruction():
+    with pytest.raises(ValueError, match="3: D=D\\*A"):
+        assemble(["@1", "D=A", "", "D=D*A"])
+
+
+def test_machine_code_writer():
+    chunk = """
+    (LOOP_#)
+    @i // comment
+    M=M+1
+    @LOOP_#
+    0;JMP
+    """
+    writer = MachineCodeWriter(capacity=1, placeholder="#")
+    writer.write("@sum\nM=0")
+    writer.write(chunk, "a")
+    writer.write(chunk, "b")
+    writer.write("(END)")
+    assembled = writer.finish()
+
+    program = ["@sum", "M=0"] + chunk.replace("#", "a").splitlines() + chunk.replace("#", "b").splitlines() + ["(END)"]
+    expected = assemble(program)
+    assert assembled.words == expected.words
+    assert assembled.labels == expected.labels == {"LOOP_a": 2, "LOOP_b": 6, "END": 10}
+    assert assembled.variables == expected.variables == {"sum": 16, "i": 17}
+    assert len(writer.compiled) == 3
+
+
+def test_pack_words():
+    words = assemble(ADD.splitlines()).words
+    packed = pack_words(words)
+    assert packed[:4] == bytes([2, 0, 0x10, 0xEC])
+    assert unpack_words(packed) == words
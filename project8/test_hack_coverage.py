@@ -0,0 +1,102 @@
+from hack_coverage import Coverage, map_vm_commands, parse_vm_comment
+from hackulator import Parser
+from VMTranslator import translate
+
+
+VM_PROGRAM = """
+    push constant 3
+    call Foo.abs 1
+    label END
+    goto END
+
+    function Foo.abs 0
+    push argument 0
+    push constant 0
+    lt
+    if-goto NEGATIVE
+    push argument 0
+    return
+    label NEGATIVE
+    push argument 0
+    neg
+    return
+
+    function Bar.unused 0
+    push constant 0
+    return
+"""
+
+
+def _run(vm_program: str, max_steps: int = 500) -> Coverage:
+    cov = Coverage(translate(vm_program))
+    cov.compy.sp = 256
+    cov.run(max_steps=max_steps)
+    return cov
+
+
+def test_parse_vm_comment():
+    assert parse_vm_comment("// push constant -1") == ["push", "constant", "-1"]
+    assert parse_vm_comment("// return") == ["return"]
+    assert parse_vm_comment("// jump to ret_addr") is None
+    assert parse_vm_comment("// Pop from stack") is None
+    assert parse_vm_comment("// push constant x") is None
+    assert parse_vm_comment("push constant 1") is None
+
+
+def test_sites_cover_every_pc():
+    """
+    Apart from instructions before the first VM comment, every pc
+    belongs to exactly one VM command.
+    """
+    hack = translate(VM_PROGRAM)
+    parser = Parser()
+    parser.parse(hack.splitlines())
+    sites = map_vm_commands(hack.splitlines(), parser.source_lines)
+
+    assert sites[0].pc_start == 0
+    assert sites[-1].pc_end == len(parser.parsed_instructions)
+    for prev, cur in zip(sites, sites[1:]):
+        assert prev.pc_end == cur.pc_start
+
+    assert [s.function for s in sites[:4]] == [None]*4
+    assert {s.file for s in sites} == {"<toplevel>", "Foo", "Bar"}
+
+
+def test_function_coverage():
+    cov = _run(VM_PROGRAM)
+    report = cov.report()
+
+    assert report["Foo"].functions_total == 1
+    assert report["Foo"].functions_hit == 1
+    assert report["Bar"].functions_total == 1
+    assert report["Bar"].functions_hit == 0
+    assert report["Bar"].missed_functions == ["Bar.unused"]
+
+
+def test_line_coverage():
+    """
+    With a positive argument, the NEGATIVE branch never runs.
+    """
+    cov = _run(VM_PROGRAM)
+    report = cov.report()
+
+    missed = [site.text for site in report["Foo"].missed_commands]
+    assert missed == ["push argument 0", "neg", "return"]
+    assert report["Foo"].commands_hit == report["Foo"].commands_total - 3
+    assert report["<toplevel>"].commands_hit == report["<toplevel>"].commands_total
+
+
+def test_asm_line_hits():
+    cov = _run("""
+        push constant 7
+        goto SKIP
+        push constant 8
+        label SKIP
+    """)
+
+    lines = cov.lines
+    hits = cov.asm_line_hits()
+
+    assert hits[lines.index("@7 // push constant 7")]
+    assert not hits[lines.index("@8 // push constant 8")]
+    assert sum(hits.values()) == sum(cov.hits)
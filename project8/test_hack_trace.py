@@ -0,0 +1,76 @@
+import pytest
+from hack_trace import TraceWriter, iter_chunks, load_trace, run_traced
+from hackulator import Compy386
+
+
+PROGRAM = """
+    @3
+    D=A
+    @R0
+    M=D
+(LOOP)
+    @R0
+    MD=M-1
+    @LOOP
+    D;JGT
+"""
+
+
+def _expected():
+    """Step through by hand and collect what the trace should hold."""
+    compy = Compy386(PROGRAM)
+    records = []
+    while compy.pc < len(compy.parsed_instructions):
+        pc = compy.pc
+        inst = compy.parsed_instructions[pc]
+        addr = compy.register_a if inst[0] == "C" and inst[1] is not None and "M" in inst[1] else -1
+        compy.step()
+        value = compy.ram[addr] if addr >= 0 else 0
+        records.append((compy.cycles, pc, compy.register_a, compy.register_d, addr, value))
+    return records
+
+
+@pytest.mark.parametrize("chunk_size", (1, 7, 1000))
+@pytest.mark.parametrize("compress", (False, True))
+def test_trace_round_trip(tmp_path, chunk_size: int, compress: bool):
+    path = tmp_path / "run.trace"
+    compy = Compy386(PROGRAM)
+
+    with TraceWriter(open(path, "wb"), chunk_size=chunk_size, compress=compress) as writer:
+        run_traced(compy, writer, max_steps=1000)
+
+    expected = _expected()
+    assert writer.num_records == len(expected)
+
+    trace = load_trace(str(path), use_numpy=False)
+    got = list(zip(trace["cycle"], trace["pc"], trace["a"], trace["d"], trace["addr"], trace["value"]))
+    assert got == expected
+
+    chunks = list(iter_chunks(str(path)))
+    assert all(len(chunk["pc"]) <= chunk_size for chunk in chunks)
+    assert sum(len(chunk["pc"]) for chunk in chunks) == len(expected)
+
+
+def test_trace_writes(tmp_path):
+    path = tmp_path / "run.trace"
+    with TraceWriter(open(path, "wb")) as writer:
+        run_traced(Compy386(PROGRAM), writer)
+
+    trace = load_trace(str(path), use_numpy=False)
+    writes = [(addr, value) for addr, value in zip(trace["addr"], trace["value"]) if addr >= 0]
+    assert writes == [(0, 3), (0, 2), (0, 1), (0, 0)]
+
+
+def test_trace_numpy(tmp_path):
+    np = pytest.importorskip("numpy")
+
+    path = tmp_path / "run.trace"
+    with TraceWriter(open(path, "wb"), chunk_size=5, compress=True) as writer:
+        run_traced(Compy386(PROGRAM), writer)
+
+    trace = load_trace(str(path), use_numpy=True)
+    expected = _expected()
+
+    assert trace["cycle"].dtype == np.uint64
+    assert trace["pc"].tolist() == [record[1] for record in expected]
+    assert int((trace["addr"] == 0).sum()) == 4
@@ -1,7 +1,9 @@
+import io
 import itertools
+from array import array
 from typing import Literal
 import pytest
-from hackulator import Compy386, Parser
+from hackulator import COMP_BITS, Compy386, MachineImage, Parser, decode_instruction, encode_instruction, read_image, write_image
 
 
 # Computes R2 = max(R0, R1)  (R0,R1,R2 refer to RAM[0],RAM[1],RAM[2])
@@ -259,3 +261,205 @@ def test_comps(dest, command):
     got = got & 0xFFFF
 
     assert got == expected
+
+
+@pytest.mark.parametrize("dest", [None, "M", "D", "MD", "A", "AM", "AD", "AMD"])
+@pytest.mark.parametrize("comp", _COMMANDS)
+def test_encode_decode(dest, comp):
+    inst = ("C", dest, comp, "JLE", "")
+    assert decode_instruction(encode_instruction(inst)) == inst
+
+
+def test_encode_aliases():
+    assert encode_instruction(("C", "DM", "M+D", None, "")) == encode_instruction(("C", "MD", "D+M", None, ""))
+    assert len(set(COMP_BITS.values())) == 28
+
+
+def test_parse_stream():
+    """
+    Streaming assembly gives the same machine code and symbols as parse().
+    """
+    parser = Parser()
+    parser.parse(MAX.splitlines())
+    expected = [encode_instruction(inst) for inst in parser.parsed_instructions]
+
+    stream_parser = Parser()
+    words = stream_parser.parse_stream(io.StringIO(MAX + "@x\n@y\n@x\n"))
+
+    assert list(words[:len(expected)]) == expected
+    assert list(words[len(expected):]) == [16, 17, 16]
+    assert stream_parser.symbol_table["OUTPUT_D"] == 12
+    assert stream_parser.parsed_instructions == []
+
+
+def test_run_max_from_words():
+    parser = Parser()
+    words = parser.parse_stream(io.StringIO(MAX))
+
+    for x, y in [(0, 1), (100, 10), (-1 & 0xFFFF, -10 & 0xFFFF)]:
+        compy = Compy386.from_words(words, parser.symbol_table)
+        compy.ram[0] = x
+        compy.ram[1] = y
+        compy.run(max_steps=100)
+        assert compy.ram[2] == max(x, y)
+
+
+def test_device_write_hook():
+    """
+    A serial port: every character written to it is collected, and
+    writes elsewhere on the same page go to RAM only.
+    """
+    program = """
+    @72
+    D=A
+    @SERIAL
+    M=D
+    @105
+    D=A
+    @SERIAL
+    M=D
+    @SERIAL
+    A=A+1
+    M=1
+    """
+    compy = Compy386(program.replace("SERIAL", "24000"))
+    out = []
+    compy.attach_device(24000, 24001, write=lambda addr, value: out.append(chr(value)))
+    compy.run()
+
+    assert "".join(out) == "Hi"
+    assert compy.ram[24000] == 105
+    assert compy.ram[24001] == 1
+
+
+def test_device_read_hook():
+    """
+    A keyboard that reports a key, and a timer that counts reads.
+    """
+    program = """
+    @KBD
+    D=M
+    @R0
+    M=D
+    @30000
+    D=M
+    D=M
+    @R1
+    M=D
+    """
+    compy = Compy386(program)
+    compy.attach_device(compy.symbol_table["KBD"], compy.symbol_table["KBD"] + 1, read=lambda addr: 75)
+
+    ticks = []
+    def timer(addr):
+        ticks.append(addr)
+        return len(ticks)
+    compy.attach_device(30000, 30001, read=timer)
+
+    compy.run()
+
+    assert compy.ram[0] == 75
+    assert compy.ram[1] == 2
+    assert ticks == [30000, 30000]
+
+
+def test_detach_device():
+    compy = Compy386("@100\nM=1")
+    device = compy.attach_device(100, 101, write=lambda addr, value: None)
+    assert compy.bus is not None
+    compy.detach_device(device)
+    assert compy.bus is None
+    compy.run()
+    assert compy.ram[100] == 1
+
+
+@pytest.mark.parametrize("compress", (False, True))
+def test_save_load_image(tmp_path, compress: bool):
+    compy = Compy386(MAX)
+    compy.ram[0] = 5
+    compy.ram[1] = 0xFFFF
+    compy.ram[20000] = 1234
+    compy.run(max_steps=7)
+
+    path = tmp_path / "state.ram"
+    compy.save_image(str(path), compress=compress)
+
+    image = read_image(str(path))
+    assert image.ram == array("H", compy.ram)
+    assert (image.register_a, image.register_d, image.pc, image.cycles) == (compy.register_a, compy.register_d, compy.pc, 7)
+
+    restored = Compy386(MAX)
+    restored.load_image(str(path))
+    assert restored.ram == compy.ram
+    assert restored.cycles == 7
+
+    # Both carry on to the same result
+    compy.run(max_steps=100)
+    restored.run(max_steps=100)
+    assert restored.ram == compy.ram
+    assert restored.ram[2] == 5
+
+
+def test_image_file_layout(tmp_path):
+    path = tmp_path / "state.ram"
+    write_image(str(path), MachineImage(1, 2, 3, 4, array("H", [0x1234, 0xABCD])))
+
+    data = path.read_bytes()
+    assert data.startswith(b"HACKRAM1")
+    assert data[-4:] == bytes([0x34, 0x12, 0xCD, 0xAB])
+
+
+def test_truncated_image(tmp_path):
+    path = tmp_path / "state.ram"
+    Compy386().save_image(str(path))
+    path.write_bytes(path.read_bytes()[:-2])
+
+    with pytest.raises(ValueError, match="truncated"):
+        read_image(str(path))
+
+
+def _state(compy: Compy386):
+    return (compy.pc, compy.register_a, compy.register_d, compy.cycles, list(compy.ram[:20]))
+
+
+def test_step_back():
+    compy = Compy386(MAX)
+    compy.ram[0] = 3
+    compy.ram[1] = 8
+    compy.enable_undo()
+
+    states = [_state(compy)]
+    for step in range(20):
+        compy.step()
+        states.append(_state(compy))
+    assert compy.ram[2] == 8
+
+    for expected in reversed(states[:-1]):
+        assert compy.step_back() == 1
+        assert _state(compy) == expected
+
+    assert compy.step_back() == 0
+
+
+def test_rewind_then_rerun():
+    compy = Compy386(MAX)
+    compy.ram[0] = 30
+    compy.ram[1] = 8
+    compy.enable_undo()
+    compy.run(max_steps=15)
+    final = _state(compy)
+
+    assert compy.step_back(10) == 10
+    assert compy.cycles == 5
+    compy.run(max_steps=10)
+    assert _state(compy) == final
+
+
+def test_undo_log_is_bounded():
+    compy = Compy386(MAX)
+    compy.enable_undo(max_steps=4)
+    compy.run(max_steps=10)
+
+    assert len(compy.undo_log) == 4
+    assert compy.step_back(100) == 4
+    assert compy.cycles == 6
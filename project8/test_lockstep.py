@@ -0,0 +1,93 @@
+from pathlib import Path
+import pytest
+from hackulator import Compy386
+from lockstep import load_engine, run_lockstep
+from VMTranslator import translate
+
+
+VM_PROGRAM = """
+    push constant 10
+    pop local 0
+    label LOOP
+    push local 0
+    push constant 1
+    sub
+    pop local 0
+    push local 0
+    push constant 7
+    add
+    pop static 0
+    push local 0
+    if-goto LOOP
+"""
+
+
+class OffByOne(Compy386):
+    """
+    Engine that writes a wrong value to RAM once, on the first write at
+    or after cycle 85 (an increment of SP, which stays wrong).
+    """
+    bad_cycle = 85
+
+    def __init__(self, program: str = ""):
+        super().__init__(program)
+        self.cycle = 0
+        self.corrupted_at = None
+
+    def step(self, *args, **kwargs):
+        inst = self.parsed_instructions[self.pc]
+        super().step(*args, **kwargs)
+        self.cycle += 1
+        if self.cycle >= self.bad_cycle and self.corrupted_at is None and inst[1] == "M":
+            self.ram[self.register_a] += 1
+            self.corrupted_at = self.cycle
+
+
+def _factory(cls, program: str):
+    def make():
+        compy = cls(program)
+        compy.set_segment_base("LCL", 300)
+        return compy
+    return make
+
+
+@pytest.mark.parametrize("batch_size", (1, 7, 64, 10_000))
+def test_same_engine_agrees(batch_size: int):
+    hack = translate(VM_PROGRAM)
+    assert run_lockstep(_factory(Compy386, hack), _factory(Compy386, hack), max_steps=5000, batch_size=batch_size) is None
+
+
+@pytest.mark.parametrize("batch_size", (1, 7, 64, 10_000))
+def test_finds_first_bad_cycle(batch_size: int):
+    hack = translate(VM_PROGRAM)
+
+    reference = OffByOne(hack)
+    reference.set_segment_base("LCL", 300)
+    reference.run(max_steps=5000)
+
+    divergence = run_lockstep(_factory(Compy386, hack), _factory(OffByOne, hack), max_steps=5000, batch_size=batch_size)
+
+    assert divergence is not None
+    assert divergence.cycle == reference.corrupted_at
+    assert divergence.what.startswith("RAM[")
+    assert divergence.value_b == divergence.value_a + 1
+
+
+def test_initial_state_mismatch():
+    def make_b():
+        compy = Compy386()
+        compy.ram[1000] = 1
+        return compy
+
+    divergence = run_lockstep(Compy386, make_b)
+    assert divergence is not None
+    assert divergence.cycle == 0
+    assert divergence.what == "RAM[1000]"
+
+
+def test_project7_engine_agrees():
+    hack = translate(VM_PROGRAM)
+    project7_compy = load_engine(str(Path(__file__).parent.parent / "project7" / "hackulator.py"))
+
+    assert project7_compy is not Compy386
+    assert run_lockstep(_factory(Compy386, hack), _factory(project7_compy, hack), max_steps=5000, batch_size=50) is None
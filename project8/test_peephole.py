@@ -0,0 +1,112 @@
+import pytest
+from hackulator import Compy386
+from peephole import optimize
+from VMTranslator import translate
+
+
+def _commands(lines):
+    return [line.split("//")[0].strip() for line in lines if line.split("//")[0].strip()]
+
+
+def test_push_pop_round_trip():
+    program = ["@7", "D=A", "@SP", "A=M", "M=D", "@SP", "M=M+1", "@SP", "AM=M-1", "D=M", "@R5", "M=D"]
+    assert _commands(optimize(program)) == ["@7", "D=A", "@SP", "A=M", "M=D", "@R5", "M=D"]
+
+
+def test_redundant_a_load():
+    program = ["@SP", "M=M+1", "@SP", "AM=M-1", "D=M"]
+    assert _commands(optimize(program)) == ["@SP", "A=M", "D=M"]
+
+
+def test_label_resets_known_a():
+    program = ["@SP", "M=M+1", "(LOOP)", "@SP", "M=M-1"]
+    assert _commands(optimize(program)) == program
+
+
+def test_redundant_d_load():
+    program = ["@R13", "M=D", "D=M", "M=D", "@R14", "D=M"]
+    assert _commands(optimize(program)) == ["@R13", "M=D", "@R14", "D=M"]
+
+
+@pytest.mark.parametrize(("program", "expected"), [
+    (["@3", "D=A", "@4", "D=D+A", "@R0", "M=D"], ["@7", "D=A", "@R0", "M=D"]),
+    (["@9", "D=A", "@4", "D=D-A", "@R0", "M=D"], ["@5", "D=A", "@R0", "M=D"]),
+    (["@SP", "D=M", "@5", "D=D-A", "@2", "D=D-A", "@ARG", "M=D"], ["@SP", "D=M", "@7", "D=D-A", "@ARG", "M=D"]),
+    # A is used afterwards, so the fold would change it
+    (["@3", "D=A", "@4", "D=D+A", "M=D"], ["@3", "D=A", "@4", "D=D+A", "M=D"]),
+    # Result doesn't fit in an A-instruction
+    (["@3", "D=A", "@4", "D=D-A", "@R0", "M=D"], ["@3", "D=A", "@4", "D=D-A", "@R0", "M=D"]),
+])
+def test_fold_constants(program, expected):
+    assert _commands(optimize(program)) == expected
+
+
+def test_keeps_comments():
+    program = ["// push constant 1", "@1 // push constant 1", "D=A", "(LOOP) // loop"]
+    assert optimize(program) == program
+
+
+VM_PROGRAMS = [
+    """
+        push constant 5
+        push constant 3
+        add
+        pop static 0
+        push constant 10
+        pop static 1
+    """,
+    """
+        push constant 2
+        pop local 0
+        push constant 7
+        pop argument 1
+        push local 0
+        push argument 1
+        lt
+        push local 0
+        push argument 1
+        gt
+        pop temp 3
+        pop pointer 1
+        push constant 99
+        pop that 2
+    """,
+    """
+        push constant 10
+        pop local 0
+        label LOOP
+        push local 0
+        push constant 1
+        sub
+        pop local 0
+        push local 0
+        push static 1
+        add
+        pop static 1
+        push local 0
+        if-goto LOOP
+    """,
+]
+
+
+@pytest.mark.parametrize("vm_program", VM_PROGRAMS)
+def test_same_result(vm_program: str):
+    """
+    The optimized program ends in exactly the same state in fewer cycles.
+    """
+    hack = translate(vm_program)
+    optimized = "\n".join(optimize(hack.splitlines()))
+
+    computers = []
+    for program in (hack, optimized):
+        compy = Compy386(program)
+        compy.set_segment_base("LCL", 300)
+        compy.set_segment_base("ARG", 400)
+        compy.run(max_steps=10_000)
+        assert compy.pc == len(compy.parsed_instructions)
+        computers.append(compy)
+
+    original, faster = computers
+    assert faster.ram == original.ram
+    assert faster.register_d == original.register_d
+    assert faster.cycles < original.cycles
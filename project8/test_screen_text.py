@@ -0,0 +1,50 @@
+from hackulator import Compy386
+from screen_text import BLACK_SQUARE, UNKNOWN, default_decoder, read_glyphs, screen_text
+
+
+def test_read_glyphs():
+    glyphs = read_glyphs()
+
+    assert len(glyphs) == 96
+    assert glyphs[ord("A")] == (12, 30, 51, 51, 63, 51, 51, 51, 51, 0, 0)
+    assert glyphs[ord(" ")] == (0,)*11
+
+
+def test_blank_screen():
+    compy = Compy386()
+    assert screen_text(compy.ram) == ""
+    assert default_decoder().lines(compy.ram) == [" "*64]*23
+
+
+def test_round_trip():
+    """
+    Characters in even and odd columns share words without clobbering
+    each other.
+    """
+    compy = Compy386()
+    decoder = default_decoder()
+
+    decoder.print_text(compy.ram, "Hello, World!")
+    decoder.print_text(compy.ram, "x = 42;", row=5, col=3)
+
+    assert screen_text(compy.ram) == "Hello, World!\n\n\n\n\n   x = 42;"
+
+
+def test_wraps_at_end_of_row():
+    compy = Compy386()
+    decoder = default_decoder()
+    decoder.print_text(compy.ram, "abcd", row=2, col=62)
+
+    lines = decoder.lines(compy.ram)
+    assert lines[2].endswith("ab")
+    assert lines[3].startswith("cd")
+
+
+def test_special_cells():
+    compy = Compy386()
+    decoder = default_decoder()
+
+    decoder.print_text(compy.ram, "\x07")
+    compy.ram[16384 + 1] = 1  # one stray pixel in column 2
+
+    assert screen_text(compy.ram) == BLACK_SQUARE + " " + UNKNOWN
@@ -0,0 +1,35 @@
+from hackulator import Compy386
+from thread_runner import BENCHMARK_PROGRAM, SharedProgram, run_many
+
+
+def test_shared_program():
+    program = SharedProgram.from_source(BENCHMARK_PROGRAM)
+    compy1 = program.make()
+    compy2 = program.make()
+
+    assert compy1.parsed_instructions is compy2.parsed_instructions
+    assert compy1.ram is not compy2.ram
+    assert compy1.symbol_table["LOOP"] == 0
+
+
+def test_run_many_matches_serial():
+    program = SharedProgram.from_source(BENCHMARK_PROGRAM)
+
+    def setup_for(ii: int):
+        def setup(compy: Compy386):
+            compy.ram[0] = 10 + ii
+            compy.ram[1] = ii
+        return setup
+
+    setups = [setup_for(ii) for ii in range(12)]
+    results = run_many(program, setups, max_steps=10_000, result=lambda compy: compy.ram[2], max_workers=4)
+
+    expected = []
+    for setup in setups:
+        compy = Compy386(BENCHMARK_PROGRAM)
+        setup(compy)
+        compy.run(max_steps=10_000)
+        expected.append(compy.ram[2])
+
+    assert results == expected
+    assert results == [(10 + ii) * ii for ii in range(12)]
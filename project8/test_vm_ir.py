@@ -0,0 +1,83 @@
+import pytest
+from VMTranslator import Translator, translate
+from vm_ir import PassManager, VMCommand, parse_vm
+
+
+def test_parse_vm():
+    commands = parse_vm("""
+        // comment
+        push constant 7   // trailing comment
+        pop static -1
+        add
+        label LOOP
+        if-goto LOOP
+        function Foo.bar 2
+        call Foo.bar 1
+        return
+        move local 1 that 2
+    """, "Foo")
+
+    assert commands == [
+        VMCommand("push", "constant", 7, "Foo"),
+        VMCommand("pop", "static", -1, "Foo"),
+        VMCommand("add", namespace="Foo"),
+        VMCommand("label", "LOOP", namespace="Foo"),
+        VMCommand("if-goto", "LOOP", namespace="Foo"),
+        VMCommand("function", "Foo.bar", 2, "Foo"),
+        VMCommand("call", "Foo.bar", 1, "Foo"),
+        VMCommand("return", namespace="Foo"),
+        VMCommand("move", "local", 1, "Foo", arg3="that", arg4=2),
+    ]
+    assert commands[0].line_number == 2
+    assert [str(command) for command in commands[:3]] == ["push constant 7", "pop static -1", "add"]
+    assert str(commands[-1]) == "move local 1 that 2"
+
+
+@pytest.mark.parametrize("line", ["jump LOOP", "push constant", "push constant x", "call Foo.bar", "move local 1 that"])
+def test_parse_errors(line: str):
+    with pytest.raises(ValueError, match="No idea how to parse"):
+        parse_vm(line)
+
+
+def test_replace():
+    command = VMCommand("push", "local", 2, "Foo", 10)
+    other = command.replace(arg1="argument")
+
+    assert other == VMCommand("push", "argument", 2, "Foo")
+    assert other.line_number == 10
+    assert command.arg1 == "local"
+
+
+def test_pass_manager_order_and_timings():
+    calls = []
+
+    def make_pass(name):
+        def run(commands):
+            calls.append(name)
+            return commands
+        return run
+
+    passes = PassManager()
+    passes.register("first", make_pass("first"))
+    passes.register("last", make_pass("last"))
+    passes.register("middle", make_pass("middle"), before="last")
+
+    commands = parse_vm("push constant 1")
+    assert passes.run(commands) is commands
+    assert calls == ["first", "middle", "last"]
+    assert passes.names() == ["first", "middle", "last"]
+    assert all(t >= 0 for t in passes.timings.values())
+    assert "middle" in passes.report()
+
+
+def test_translator_runs_passes():
+    """
+    A pass that rewrites "push constant 1" into "push constant 2".
+    """
+    def bump(commands):
+        return [c.replace(arg2=2) if (c.op, c.arg1, c.arg2) == ("push", "constant", 1) else c for c in commands]
+
+    tor = Translator()
+    tor.passes.register("bump", bump)
+
+    assert tor.translate("push constant 1") == translate("push constant 2")
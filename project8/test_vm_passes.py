@@ -0,0 +1,651 @@
+import pytest
+from hackulator import Compy386
+from VMTranslator import Translator, dead_function_report, translate, translate_files, write_shared_routines
+from vm_ir import parse_vm
+from vm_passes import (
+    DeadFunctionElimination, FrameElision, Inliner, function_blocks, fuse_compare_branch, fuse_push_pop, propagate_copies,
+    remove_dead_stores, thread_jumps
+)
+
+
+def _vm(commands) -> list:
+    return [str(command) for command in commands]
+
+
+def test_fuse_push_pop():
+    commands = parse_vm("""
+        push local 2
+        pop that 7
+        push constant 1
+        push constant 2
+        add
+        pop static 3
+    """)
+    assert _vm(fuse_push_pop(commands)) == [
+        "move local 2 that 7",
+        "push constant 1",
+        "push constant 2",
+        "add",
+        "pop static 3",
+    ]
+
+
+def test_array_assignment_forwarding():
+    """
+    let a[i] = x; as the Jack compiler writes it.
+    """
+    commands = parse_vm("""
+        push local 0
+        push local 1
+        add
+        push static 2
+        pop temp 0
+        pop pointer 1
+        push temp 0
+        pop that 0
+    """)
+    optimized = propagate_copies(fuse_push_pop(commands))
+    assert _vm(optimized)[-3:] == [
+        "move static 2 temp 0",
+        "pop pointer 1",
+        "move static 2 that 0",
+    ]
+
+
+@pytest.mark.parametrize("clobber", [
+    "pop static 2",       # the source changes
+    "pop temp 0",         # the copy changes
+    "pop local 0",        # might alias either
+    "label L",            # someone might jump here
+    "call Foo.bar 0",
+])
+def test_copies_forgotten(clobber: str):
+    commands = parse_vm(f"""
+        move static 2 temp 0
+        {clobber}
+        push temp 0
+    """)
+    assert _vm(propagate_copies(commands))[-1] == "push temp 0"
+
+
+def test_indirect_sources_not_forwarded():
+    commands = parse_vm("""
+        move that 0 temp 0
+        pop pointer 1
+        push temp 0
+    """)
+    assert _vm(propagate_copies(commands))[-1] == "push temp 0"
+
+
+def test_remove_dead_stores():
+    commands = parse_vm("""
+        move constant 0 temp 0
+        push constant 5
+        pop temp 0
+        move constant 0 temp 1
+        push temp 1
+        move constant 0 temp 2
+        label L
+        move constant 0 temp 3
+        push local 0
+        move constant 0 temp 3
+    """)
+    assert _vm(remove_dead_stores(commands)) == [
+        "push constant 5",
+        "pop temp 0",
+        "move constant 0 temp 1",
+        "push temp 1",
+        "move constant 0 temp 2",
+        "label L",
+        "move constant 0 temp 3",
+        "push local 0",
+        "move constant 0 temp 3",
+    ]
+
+
+def test_fuse_compare_branch():
+    commands = parse_vm("""
+        lt
+        not
+        if-goto A
+        eq
+        if-goto B
+        gt
+        pop temp 0
+        not
+        if-goto C
+        not
+        if-goto D
+    """)
+    assert _vm(fuse_compare_branch(commands)) == [
+        "if-ge A",
+        "if-eq B",
+        "gt",
+        "pop temp 0",
+        "not",
+        "if-goto C",
+        "not",
+        "if-goto D",
+    ]
+
+
+@pytest.mark.parametrize(("x", "y"), [(0, 0), (1, 2), (2, 1), (-1, 1), (1, -1), (-3, -3)])
+@pytest.mark.parametrize("cmp", ["eq", "gt", "lt"])
+@pytest.mark.parametrize("negate", [False, True])
+@pytest.mark.parametrize("cache_top", [False, True])
+def test_compare_goto_codegen(x: int, y: int, cmp: str, negate: bool, cache_top: bool):
+    vm_program = f"""
+        push constant 100
+        push constant {x}
+        push constant {y}
+        {cmp}
+        {"not" if negate else ""}
+        if-goto TAKEN
+        push constant 0
+        goto END
+        label TAKEN
+        push constant 1
+        label END
+    """
+    taken = {"eq": x == y, "gt": x > y, "lt": x < y}[cmp] != negate
+
+    tor = Translator(optimize=True, cache_top=cache_top)
+    hack = tor.translate(vm_program)
+    assert "if-" in hack
+
+    compy = Compy386(hack)
+    compy.run()
+    assert compy.get_stack() == [100, int(taken)]
+
+
+@pytest.mark.parametrize("dst", ["local", "argument", "this", "that"])
+@pytest.mark.parametrize("dst_num", [0, 1, 4, 9])
+def test_move_codegen(dst: str, dst_num: int):
+    vm_program = f"""
+        move static 0 {dst} {dst_num}
+        move constant 7 temp 3
+        move temp 3 pointer 0
+    """
+    compy = Compy386(translate(vm_program))
+    for segment, base in zip(("LCL", "ARG", "THIS", "THAT"), (300, 400, 500, 600)):
+        compy.set_segment_base(segment, base)
+    compy.ram[compy.symbol_table["default.0"]] = 1234
+    compy.run()
+
+    base = {"local": 300, "argument": 400, "this": 500, "that": 600}[dst]
+    assert compy.ram[base + dst_num] == 1234
+    assert compy.ram[5 + 3] == 7
+    assert compy.ram[compy.symbol_table["THIS"]] == 7
+    assert compy.sp == 256
+
+
+def test_thread_jumps():
+    commands = thread_jumps(parse_vm(JACK_CONTROL_FLOW))
+    assert _vm(commands) == [
+        "push argument 0",
+        "if-goto IF_TRUE0",
+        "goto IF_FALSE0",
+        "label IF_TRUE0",
+        "push argument 1",
+        "if-goto IF_TRUE1",
+        "goto IF_END0",  # was IF_FALSE1, which only led to "goto IF_END0"
+        "label IF_TRUE1",
+        "push constant 1",
+        "pop static 0",
+        "goto IF_END0",
+        "label IF_FALSE0",
+        "push constant 2",
+        "pop static 0",
+        "label IF_END0",  # merged with WHILE_EXP0
+        "push static 0",
+        "push constant 0",
+        "eq",
+        "if-goto WHILE_END0",
+        "push static 0",
+        "push constant 1",
+        "sub",
+        "pop static 0",
+        "goto IF_END0",
+        "label WHILE_END0",
+        "push argument 0",
+        "if-goto IF_TRUE2",
+        "goto IF_FALSE2",
+        "label IF_TRUE2",
+        "push constant 3",
+        "pop static 1",
+        "label IF_FALSE2",  # "goto IF_END2" fell through to here
+    ]
+
+
+def test_thread_jumps_within_file():
+    # Bar's A isn't Foo's A
+    commands = parse_vm("goto A", "Foo") + parse_vm("label A\ngoto A", "Bar") + parse_vm("label A", "Foo")
+    assert thread_jumps(commands) == commands
+
+
+# if/else, nested if, while and empty else, laid out like the Jack compiler does
+JACK_CONTROL_FLOW = """
+    push argument 0
+    if-goto IF_TRUE0
+    goto IF_FALSE0
+    label IF_TRUE0
+    push argument 1
+    if-goto IF_TRUE1
+    goto IF_FALSE1
+    label IF_TRUE1
+    push constant 1
+    pop static 0
+    label IF_FALSE1
+    goto IF_END0
+    label IF_FALSE0
+    push constant 2
+    pop static 0
+    label IF_END0
+    label WHILE_EXP0
+    push static 0
+    push constant 0
+    eq
+    if-goto WHILE_END0
+    push static 0
+    push constant 1
+    sub
+    pop static 0
+    goto WHILE_EXP0
+    label WHILE_END0
+    push argument 0
+    if-goto IF_TRUE2
+    goto IF_FALSE2
+    label IF_TRUE2
+    push constant 3
+    pop static 1
+    goto IF_END2
+    label IF_FALSE2
+    label IF_END2
+"""
+
+
+VM_PROGRAMS = [
+    # Array assignments: let a[i] = x; let a[j] = a[i] + 1;
+    """
+        push local 0
+        push constant 2
+        add
+        push static 0
+        pop temp 0
+        pop pointer 1
+        push temp 0
+        pop that 0
+        push local 0
+        push constant 3
+        add
+        push local 0
+        push constant 2
+        add
+        pop pointer 1
+        push that 0
+        push constant 1
+        add
+        pop temp 0
+        pop pointer 1
+        push temp 0
+        pop that 0
+    """,
+    # Moves between every kind of segment
+    """
+        push argument 1
+        pop local 6
+        push local 6
+        pop this 0
+        push constant 0
+        pop temp 0
+        push this 0
+        pop temp 0
+        push temp 0
+        pop static 0
+        push static 0
+        pop pointer 1
+        push constant 9
+        pop that 1
+    """,
+    JACK_CONTROL_FLOW,
+]
+
+
+@pytest.mark.parametrize("vm_program", VM_PROGRAMS)
+def test_same_result(vm_program: str):
+    computers = []
+    for optimize in (False, True):
+        compy = Compy386(Translator(optimize=optimize).translate(vm_program))
+        for segment, base in zip(("LCL", "ARG", "THIS", "THAT"), (300, 400, 500, 600)):
+            compy.set_segment_base(segment, base)
+        compy.set_in_segment("ARG", 1, 42)
+        compy.ram[compy.symbol_table["default.0"]] = 17
+        compy.run(max_steps=10_000)
+        computers.append(compy)
+
+    original, optimized = computers
+    # R13-R15 are scratch, and anything above SP is garbage
+    scratch = set(range(13, 16)) | set(range(original.sp, 300))
+    assert optimized.sp == original.sp
+    assert [v for ii, v in enumerate(optimized.ram) if ii not in scratch] == \
+        [v for ii, v in enumerate(original.ram) if ii not in scratch]
+    assert optimized.cycles < original.cycles
+
+
+SYS_VM = """
+    function Sys.init 0
+    call Main.main 0
+    pop temp 0
+    label END
+    goto END
+"""
+
+MAIN_VM = """
+    function Main.main 0
+    push constant 3
+    call Main.fact 1
+    pop static 0
+    push constant 0
+    return
+
+    function Main.fact 1
+    push argument 0
+    push constant 1
+    gt
+    if-goto RECURSE
+    push constant 1
+    return
+    label RECURSE
+    push argument 0
+    push argument 0
+    push constant 1
+    sub
+    call Main.fact 1
+    call Math.multiply 2
+    return
+
+    function Main.unused 0
+    call Main.alsoUnused 0
+    return
+
+    function Main.alsoUnused 0
+    call Main.unused 0
+    return
+"""
+
+MATH_VM = """
+    function Math.multiply 1
+    label LOOP
+    push argument 1
+    push constant 0
+    eq
+    if-goto DONE
+    push local 0
+    push argument 0
+    add
+    pop local 0
+    push argument 1
+    push constant 1
+    sub
+    pop argument 1
+    goto LOOP
+    label DONE
+    push local 0
+    return
+
+    function Math.divide 0
+    push constant 0
+    return
+"""
+
+
+def test_function_blocks():
+    commands = parse_vm("push constant 1", "A") + parse_vm(MATH_VM, "Math") + parse_vm("call Math.divide 0", "B")
+    blocks = function_blocks(commands)
+
+    assert [name for name, block in blocks] == [None, "Math.multiply", "Math.divide", None]
+    assert sum(len(block) for name, block in blocks) == len(commands)
+
+
+def test_dead_function_elimination():
+    commands = (
+        parse_vm("call Sys.init 0", "init")
+        + parse_vm(SYS_VM, "Sys")
+        + parse_vm(MAIN_VM, "Main")
+        + parse_vm(MATH_VM, "Math")
+    )
+    pruner = DeadFunctionElimination()
+    kept = pruner(commands)
+
+    assert sorted(pruner.removed) == ["Main.alsoUnused", "Main.unused", "Math.divide"]
+    assert {command.arg1 for command in kept if command.op == "function"} == \
+        {"Sys.init", "Main.main", "Main.fact", "Math.multiply"}
+    assert len(kept) + sum(len(block) for block in pruner.removed.values()) == len(commands)
+
+    report = dead_function_report(Translator(), pruner.removed)
+    assert report.startswith("removed 3 functions")
+    assert "Main.unused" in report
+
+
+def test_top_level_calls_are_roots():
+    commands = parse_vm("call Math.divide 0", "Main") + parse_vm(MATH_VM, "Math")
+    pruner = DeadFunctionElimination(roots=())
+    pruner(commands)
+    assert list(pruner.removed) == ["Math.multiply"]
+
+
+def test_pruned_program_runs(tmp_path):
+    for name, vm in (("Sys", SYS_VM), ("Main", MAIN_VM), ("Math", MATH_VM)):
+        (tmp_path / f"{name}.vm").write_text(vm)
+    files = sorted(tmp_path.glob("*.vm"))
+
+    tor = Translator()
+    tor.passes.register("remove_dead_functions", DeadFunctionElimination())
+    pruned = translate_files(tor, files, True, whole_program=True)
+    full = translate_files(Translator(), files, True)
+
+    assert "(Math.divide)" in full
+    assert "(Math.divide)" not in pruned
+
+    for hack in (full, pruned):
+        compy = Compy386(hack)
+        end = compy.symbol_table["Sys.END"]
+        while compy.pc != end:
+            compy.step()
+        assert compy.ram[compy.symbol_table["Main.0"]] == 6
+
+
+LIB_VM = """
+    function Lib.abs 0
+    push argument 0
+    push constant 0
+    lt
+    not
+    if-goto IF_END
+    push argument 0
+    neg
+    return
+    label IF_END
+    push argument 0
+    return
+
+    // Memory.peek
+    function Lib.peek 0
+    push argument 0
+    pop pointer 1
+    push that 0
+    return
+
+    function Lib.sumTo 1
+    label LOOP
+    push argument 0
+    push constant 0
+    eq
+    if-goto DONE
+    push local 0
+    push argument 0
+    add
+    pop local 0
+    push argument 0
+    push constant 1
+    sub
+    pop argument 0
+    goto LOOP
+    label DONE
+    push local 0
+    return
+
+    function Lib.leftovers 0
+    push constant 1
+    push constant 2
+    return
+
+    function Lib.calls 0
+    push constant 1
+    call Lib.abs 1
+    return
+"""
+
+INLINE_MAIN_VM = """
+    push constant 700
+    pop pointer 1
+    push constant 3
+    neg
+    call Lib.abs 1
+    push constant 5
+    call Lib.abs 1
+    add
+    push constant 600
+    call Lib.peek 1
+    push constant 4
+    call Lib.sumTo 1
+    push constant 0
+    call Lib.leftovers 0
+    pop temp 1
+    call Lib.calls 0
+    label END
+    goto END
+"""
+
+
+def _inline(inliner: Inliner) -> list:
+    return inliner(parse_vm(INLINE_MAIN_VM, "Main") + parse_vm(LIB_VM, "Lib"))
+
+
+def test_inliner_choice():
+    inliner = Inliner()
+    _inline(inliner)
+    # Lib.calls isn't a leaf, but its call to Lib.abs is inlined
+    assert inliner.inlined == {"Lib.abs": 3, "Lib.peek": 1}
+
+    inliner = Inliner(max_size=0, allow=["Lib.sumTo", "Lib.leftovers", "Lib.calls"])
+    _inline(inliner)
+    assert inliner.inlined == {"Lib.sumTo": 1}
+
+
+def test_inlined_labels_are_unique():
+    commands = _inline(Inliner())
+    labels = [command.arg1 for command in commands if command.op == "label"]
+    assert len(labels) == len(set(labels))
+    assert "IF_END$inline.1" in labels and "IF_END$inline.2" in labels
+
+
+def test_inliner_needs_free_temps():
+    vm_program = INLINE_MAIN_VM + "\n".join(f"push temp {ii}" for ii in range(8))
+    inliner = Inliner()
+    inliner(parse_vm(vm_program, "Main") + parse_vm(LIB_VM, "Lib"))
+    # Only the call inside Lib.calls
+    assert inliner.inlined == {"Lib.abs": 1}
+
+
+@pytest.mark.parametrize("optimize", [False, True])
+def test_inlined_program_runs(optimize: bool):
+    computers = []
+    for inline in (False, True):
+        tor = Translator(optimize=optimize)
+        if inline:
+            tor.passes.register("inline", Inliner(allow=["Lib.sumTo"]), before=(tor.passes.names() or [None])[0])
+        hack = tor.translate_commands(parse_vm(INLINE_MAIN_VM, "Main") + parse_vm(LIB_VM, "Lib"))
+
+        compy = Compy386(hack)
+        compy.ram[600] = 1234
+        compy.set_segment_base("LCL", 300)
+        compy.set_segment_base("ARG", 400)
+        end = compy.symbol_table["Main.END"]
+        while compy.pc != end:
+            compy.step()
+        computers.append(compy)
+
+    original, inlined = computers
+    assert original.get_stack() == [8, 1234, 10, 0, 1] == inlined.get_stack()
+    assert (inlined.lcl, inlined.arg, inlined.that) == (300, 400, 700)
+    assert inlined.ram[6] == 2
+    assert inlined.cycles < original.cycles
+
+
+LEAF_VM = """
+    function Leaf.newLine 0
+    push constant 128
+    return
+
+    // Ignores its arguments
+    function Leaf.pick 0
+    push static 0
+    push this 1
+    add
+    return
+"""
+
+LEAF_MAIN_VM = """
+    push constant 700
+    pop pointer 0
+    call Leaf.newLine 0
+    push constant 1
+    push constant 2
+    call Leaf.pick 2
+    push constant 3
+    call Lib.abs 1
+    label END
+    goto END
+"""
+
+
+def _leaf_program() -> list:
+    return parse_vm(LEAF_MAIN_VM, "Main") + parse_vm(LEAF_VM, "Leaf") + parse_vm(LIB_VM, "Lib")
+
+
+def test_frame_elision_choice():
+    elision = FrameElision()
+    commands = elision(_leaf_program())
+
+    # Lib uses arguments, sets pointer, has locals, leaves the stack
+    # unbalanced or makes calls
+    assert elision.elided == ["Leaf.newLine", "Leaf.pick"]
+    assert "call-leaf Leaf.pick 2" in _vm(commands)
+    assert "function-leaf Leaf.newLine" in _vm(commands)
+    assert _vm(commands).count("return-leaf") == 2
+    assert "call Lib.abs 1" in _vm(commands)
+
+
+@pytest.mark.parametrize("options", [{}, {"cache_top": True}, {"shared_routines": True}, {"optimize": True}])
+def test_elided_frames_run(options: dict):
+    computers = []
+    for elide in (False, True):
+        tor = Translator(**options)
+        if elide:
+            tor.passes.register("elide_frames", FrameElision())
+        hack = "\n".join([tor.translate_commands(_leaf_program()), write_shared_routines()])
+
+        compy = Compy386(hack)
+        compy.ram[701] = 10
+        compy.set_segment_base("LCL", 300)
+        compy.set_segment_base("ARG", 400)
+        end = compy.symbol_table["Main.END"]
+        while compy.pc != end:
+            compy.step()
+        computers.append(compy)
+
+    original, elided = computers
+    assert original.get_stack() == [128, 10, 3] == elided.get_stack()
+    assert (elided.lcl, elided.arg, elided.this) == (300, 400, 700)
+    assert elided.cycles < original.cycles
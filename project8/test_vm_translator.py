@@ -1,8 +1,15 @@
 from typing import Callable, Literal
 import pytest
 from hackulator import Compy386
-from VMTranslator import remove_comments, remove_whitespace, translate
+from VMTranslator import (
+    SHARED_CALL_RETURN_CYCLES, SHARED_CMP_FALSE_CYCLES, SHARED_CMP_TRUE_CYCLES, Translator, assemble_files, count_instructions,
+    SEGMENT_VM_TO_HACK, remove_comments, remove_whitespace, strip_program, translate, translate_file, translate_files, translate_files_to,
+    write_call,
+    write_cmp, write_push, write_shared_routines
+)
 from operator import and_, neg, or_, add, sub, not_, invert
+from translation_cache import TranslationCache
+from HackAssembler import assemble
 
 
 
@@ -447,3 +454,355 @@ def test_call():
     """
 
 
+# ==== Code-size mode
+
+CALL_PROGRAM = """
+    push constant 7
+    push constant 2
+    call Foo.pick 2
+    push constant 5
+    push constant 9
+    call Foo.pick 2
+    label END
+    goto END
+
+    // push the larger argument, or 1 if they're equal
+    function Foo.pick 1
+    push argument 0
+    push argument 1
+    eq
+    if-goto SAME
+    push argument 0
+    push argument 1
+    gt
+    if-goto FIRST
+    push argument 1
+    return
+    label FIRST
+    push argument 0
+    return
+    label SAME
+    push constant 1
+    return
+"""
+
+
+def _run_to_end(shared: bool, vm_program: str = CALL_PROGRAM) -> Compy386:
+    hack = Translator(shared_routines=shared).translate(vm_program)
+    if shared:
+        hack = write_shared_routines() + "\n" + hack
+
+    compy = Compy386(hack)
+    compy.set_segment_base("LCL", 300)
+    compy.set_segment_base("ARG", 400)
+    end = compy.symbol_table["default.END"]
+    while compy.pc != end:
+        compy.step()
+    return compy
+
+
+def test_shared_routines():
+    inline = _run_to_end(shared=False)
+    shared = _run_to_end(shared=True)
+
+    assert inline.get_stack() == [7, 9]
+    assert shared.get_stack() == [7, 9]
+    assert (shared.lcl, shared.arg) == (300, 400)
+    assert count_instructions(Translator(shared_routines=True).translate(CALL_PROGRAM)) < \
+        count_instructions(translate(CALL_PROGRAM)) // 2
+
+    # 2 calls, 1 true and 3 false comparisons, and the jump over the
+    # shared routines
+    assert shared.cycles - inline.cycles == \
+        2*SHARED_CALL_RETURN_CYCLES + SHARED_CMP_TRUE_CYCLES + 3*SHARED_CMP_FALSE_CYCLES + 2
+
+
+@pytest.mark.parametrize(("x", "y"), [(0, 0), (0, 1), (1, 0), (-1, 1), (1, -1)])
+@pytest.mark.parametrize("command", ["eq", "gt", "lt"])
+def test_shared_cmp(x: int, y: int, command: str):
+    vm_program = f"""
+        push constant {x}
+        push constant {y}
+        {command}
+        label END
+    """
+    expected = {"eq": x == y, "gt": x > y, "lt": x < y}[command]
+
+    compy = _run_to_end(True, vm_program)
+    assert compy.get_stack() == [0xFFFF if expected else 0]
+
+
+
+# ==== Top-of-stack caching
+
+CACHE_PROGRAMS = [
+    # Arithmetic, with results popped to every kind of segment
+    """
+        push constant 7
+        push constant 5
+        sub
+        push constant 3
+        neg
+        add
+        push constant 12
+        push constant 10
+        and
+        or
+        not
+        pop local 0
+        push argument 1
+        push argument 1
+        add
+        pop this 7
+        push constant 9
+        pop that 1
+        push constant 3
+        pop static 2
+        push constant 4
+        pop temp 6
+        push constant 500
+        pop pointer 0
+    """,
+    # Comparisons, including their results left on the stack
+    """
+        push constant 1
+        push constant 2
+        lt
+        push constant 2
+        push constant 1
+        gt
+        push constant 3
+        push constant 3
+        eq
+        push constant 3
+        push constant 4
+        eq
+        push constant 0
+        push constant 1
+        neg
+        gt
+    """,
+    # A countdown loop summing into local 1
+    """
+        push constant 5
+        pop local 0
+        label LOOP
+        push local 0
+        push local 1
+        add
+        pop local 1
+        push local 0
+        push constant 1
+        sub
+        pop local 0
+        push local 0
+        push constant 0
+        gt
+        if-goto LOOP
+        push local 1
+    """,
+    CALL_PROGRAM,
+]
+
+
+@pytest.mark.parametrize("vm_program", CACHE_PROGRAMS)
+@pytest.mark.parametrize("shared", [False, True])
+def test_cache_top(vm_program: str, shared: bool):
+    computers = []
+    for cache_top in (False, True):
+        hack = Translator(shared_routines=shared, cache_top=cache_top).translate(vm_program + "\nlabel END")
+        if shared:
+            hack = write_shared_routines() + "\n" + hack
+
+        compy = Compy386(hack)
+        for segment, base in zip(("LCL", "ARG", "THIS", "THAT"), (300, 400, 500, 600)):
+            compy.set_segment_base(segment, base)
+        compy.set_in_segment("ARG", 1, 21)
+        end = compy.symbol_table["default.END"]
+        while compy.pc != end:
+            compy.step()
+        computers.append(compy)
+
+    original, cached = computers
+    # R13-R15 are scratch, ret_addr holds a code address, and a cached
+    # top of stack is never written above SP
+    scratch = set(range(13, 16)) | set(range(original.sp, 300))
+    scratch |= {compy.symbol_table["ret_addr"] for compy in computers if "ret_addr" in compy.symbol_table}
+    assert cached.get_stack() == original.get_stack()
+    assert [v for ii, v in enumerate(cached.ram) if ii not in scratch] == \
+        [v for ii, v in enumerate(original.ram) if ii not in scratch]
+    assert cached.cycles <= original.cycles
+
+
+# ==== Template cache and streaming output
+
+def test_expansions_cached():
+    tor = Translator()
+    first = tor.translate("push local 3")
+    assert tor.translate("push local 3") == first
+    assert tor.expansions[(False, write_push, "push", "local", 3, "default")] in first
+    assert len(tor.expansions) == 1
+
+
+def test_numbered_templates():
+    """
+    Cached templates number their labels like the write_* functions.
+    """
+    tor = Translator()
+    tor.translate("eq\ncall Foo.bar 2")
+    hack = tor.translate("eq\neq\ncall Foo.bar 2")
+
+    label_count = {"eq": 1, "Foo.bar.call": 1}
+    expected = "\n".join([
+        "// eq", write_cmp("eq", "JNE", label_count),
+        "// eq", write_cmp("eq", "JNE", label_count),
+        "// call Foo.bar 2", write_call("Foo.bar", 2, label_count),
+    ])
+    assert hack == expected
+    assert tor.label_count == label_count
+
+
+@pytest.mark.parametrize("options", [{}, {"cache_top": True}, {"shared_routines": True, "optimize": True}])
+@pytest.mark.parametrize("strip", [False, True])
+def test_translate_files_to(tmp_path, options: dict, strip: bool):
+    (tmp_path / "Main.vm").write_text(CALL_PROGRAM.replace("Foo.", "Main."))
+    (tmp_path / "Sys.vm").write_text("function Sys.init 0\ncall Main.pick 0\nlabel END\ngoto END")
+    files = sorted(tmp_path.glob("*.vm"))
+
+    expected = translate_files(Translator(**options), files, True)
+    if strip:
+        expected = strip_program(expected)
+
+    out_path = tmp_path / "out.asm"
+    with open(out_path, "w", buffering=1 << 16) as fh:
+        translate_files_to(fh, Translator(**options), files, True, strip=strip)
+
+    assert out_path.read_text() == expected + "\n"
+
+
+# ==== Per-file labels and parallel translation
+
+def _write_program(path) -> list:
+    (path / "Main.vm").write_text(CALL_PROGRAM.replace("Foo.", "Main."))
+    (path / "Other.vm").write_text("function Other.f 0\npush constant 1\npush constant 2\nlt\npop temp 1\npush constant 4\npush constant 2\ncall Main.pick 2\nreturn")
+    (path / "Sys.vm").write_text("function Sys.init 0\ncall Other.f 0\nlabel END\ngoto END")
+    return sorted(path.glob("*.vm"))
+
+
+def test_file_labels(tmp_path):
+    files = _write_program(tmp_path)
+    hack = translate_files(Translator(file_labels=True), files, True)
+
+    assert "(eq_Main.0)" in hack
+    assert "(lt_Other.0)" in hack
+    assert "(Main.pick.call.Other.0)" in hack
+
+    # Each file translates the same on its own
+    for file in files:
+        assert translate_file(Translator(file_labels=True).options(), False, file.stem, file.read_text())[:-1] in hack
+
+    compy = Compy386(hack)
+    end = compy.symbol_table["Sys.END"]
+    while compy.pc != end:
+        compy.step()
+    assert compy.get_stack()[-1] == 4
+    assert compy.ram[6] == 0xFFFF
+
+
+@pytest.mark.parametrize("options", [{}, {"optimize": True, "cache_top": True}])
+def test_parallel_translation(tmp_path, options: dict):
+    files = _write_program(tmp_path)
+    serial = translate_files(Translator(file_labels=True, **options), files, True)
+
+    for jobs in (1, 2):
+        assert translate_files(Translator(file_labels=True, **options), files, True, jobs=jobs) == serial
+
+
+def test_translation_cache(tmp_path):
+    files = _write_program(tmp_path)
+    cache = TranslationCache(tmp_path / "cache")
+
+    def build(**options):
+        return translate_files(Translator(file_labels=True, **options), files, True, cache=cache)
+
+    hack = build()
+    assert hack == translate_files(Translator(file_labels=True), files, True)
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    assert build() == hack
+    assert (cache.hits, cache.misses) == (3, 3)
+
+    # Only the changed file is translated again
+    files[1].write_text(files[1].read_text().replace("push constant 4", "push constant 5"))
+    hack = build()
+    assert hack == translate_files(Translator(file_labels=True), files, True)
+    assert (cache.hits, cache.misses) == (5, 4)
+
+    # Other options, other chunks
+    build(cache_top=True)
+    assert (cache.hits, cache.misses) == (5, 7)
+
+
+# ==== Straight to machine code
+
+@pytest.mark.parametrize("options", [{}, {"cache_top": True}, {"shared_routines": True}, {"file_labels": True, "optimize": True}])
+@pytest.mark.parametrize("whole_program", [False, True])
+def test_assemble_files(tmp_path, options: dict, whole_program: bool):
+    files = _write_program(tmp_path)
+
+    expected = assemble(translate_files(Translator(**options), files, True, whole_program).splitlines())
+    assembled = assemble_files(Translator(**options), files, True, whole_program)
+
+    assert assembled.words == expected.words
+    assert assembled.labels == expected.labels
+    assert assembled.variables == expected.variables
+
+    compy = Compy386.from_words(assembled.words)
+    end = assembled.labels["Sys.END"]
+    while compy.pc != end:
+        compy.step()
+    assert compy.get_stack()[-1] == 4
+
+
+# ==== Specialized templates
+
+@pytest.mark.parametrize("cache_top", [False, True])
+@pytest.mark.parametrize("num", [0, 1, -1, 2, -2, 5, 32767, 32768, -32767])
+@pytest.mark.parametrize("token", ["add", "sub"])
+def test_constant_arithmetic(cache_top: bool, num: int, token: str):
+    vm_program = f"""
+        push constant {num}
+        push constant 1000
+        push constant {num}
+        {token}
+        push constant 3
+        push constant {num}
+        {token}
+        pop temp 0
+    """
+    compy = Compy386(Translator(cache_top=cache_top).translate(vm_program))
+    compy.run(max_steps=1000)
+
+    op = add if token == "add" else sub
+    assert compy.get_stack() == [num & 0xFFFF, op(1000, num) & 0xFFFF]
+    assert compy.ram[5] == op(3, num) & 0xFFFF
+
+
+def test_specialized_templates():
+    assert count_instructions(translate("push constant 0")) == 4
+    assert count_instructions(translate("push constant 1\nadd")) == 3
+    assert count_instructions(translate("pop pointer 1")) == 5
+    assert "R15" not in translate("pop local 1\npop argument 0\npop that 4")
+    assert count_instructions(translate("push local 1")) == count_instructions(translate("push local 9")) - 2
+
+
+@pytest.mark.parametrize("segment", ["local", "argument", "this", "that"])
+@pytest.mark.parametrize("num", [0, 1, 2, 3, 4, 5, 9])
+def test_segment_offsets(segment: str, num: int):
+    compy = Compy386(translate(f"push constant 17\npop {segment} {num}\npush {segment} {num}\npush constant 3\nadd"))
+    for seg, base in zip(("LCL", "ARG", "THIS", "THAT"), (300, 400, 500, 600)):
+        compy.set_segment_base(seg, base)
+    compy.run(max_steps=1000)
+
+    assert compy.get_in_segment(SEGMENT_VM_TO_HACK[segment], num) == 17
+    assert compy.get_stack() == [20]
@@ -0,0 +1,122 @@
+import argparse
+import dataclasses
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Callable, Mapping, Optional, Sequence, TypeVar
+
+from hackulator import Compy386, Parser
+
+R = TypeVar("R")
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedProgram:
+    """
+    A parsed Hack program that many computers can run at once.
+
+    Nothing here is mutable, so threads share it without locks or
+    copies; only RAM and registers are per computer.
+    """
+    instructions: tuple[tuple[str, ...], ...]
+    symbol_table: Mapping[str, int]
+
+    @classmethod
+    def from_source(cls, program: str) -> "SharedProgram":
+        parser = Parser()
+        parser.parse(program.splitlines())
+        return cls(tuple(parser.parsed_instructions), MappingProxyType(parser.symbol_table))
+
+    def make(self) -> Compy386:
+        return Compy386.from_parsed(self.instructions, self.symbol_table)
+
+
+def run_many(
+    program: SharedProgram,
+    setups: Sequence[Callable[[Compy386], None]],
+    max_steps: int = 1000,
+    result: Callable[[Compy386], R] = lambda compy: compy,  # type: ignore
+    max_workers: Optional[int] = None,
+) -> list[R]:
+    """
+    Run one computer per setup on a thread pool.
+
+    Args:
+        program: the program every computer runs
+        setups: each one seeds the RAM/registers of a fresh computer
+        max_steps: passed to Compy386.run
+        result: what to keep from each finished computer
+        max_workers: thread pool size, default as ThreadPoolExecutor
+    Returns:
+        result(compy) for each setup, in the same order
+    """
+
+    def job(setup: Callable[[Compy386], None]) -> R:
+        compy = program.make()
+        setup(compy)
+        compy.run(max_steps=max_steps)
+        return result(compy)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(job, setups))
+
+
+# Counts down from RAM[0], adding RAM[1] into RAM[2] each time round.
+BENCHMARK_PROGRAM = """
+(LOOP)
+    @R0
+    D=M
+    @END
+    D;JEQ
+    @R1
+    D=M
+    @R2
+    M=D+M
+    @R0
+    M=M-1
+    @LOOP
+    0;JMP
+(END)
+"""
+
+
+def benchmark(num_jobs: int, steps_per_job: int, worker_counts: Sequence[int]):
+    """
+    Time the same batch of jobs with different thread pool sizes.
+    Only builds without the GIL will scale.
+    """
+    program = SharedProgram.from_source(BENCHMARK_PROGRAM)
+
+    # 12 instructions per loop, 4 more to exit
+    iterations = (steps_per_job - 4) // 12
+
+    def setup_for(ii: int) -> Callable[[Compy386], None]:
+        def setup(compy: Compy386):
+            compy.ram[0] = iterations
+            compy.ram[1] = ii
+        return setup
+
+    setups = [setup_for(ii) for ii in range(num_jobs)]
+    gil = sys._is_gil_enabled() if hasattr(sys, "_is_gil_enabled") else True
+    print(f"{num_jobs} jobs x {steps_per_job} steps, GIL {'enabled' if gil else 'disabled'}")
+
+    baseline = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        results = run_many(program, setups, max_steps=steps_per_job, result=lambda compy: compy.ram[2], max_workers=workers)
+        elapsed = time.perf_counter() - start
+
+        assert results == [(ii * iterations) & 0xFFFF for ii in range(num_jobs)]
+        baseline = baseline or elapsed
+        print(f"{workers:3d} workers: {elapsed:7.3f} s  speedup {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser("thread_runner", description="Benchmark running many emulators on a thread pool")
+    p.add_argument("--jobs", type=int, default=16, help="Number of computers to run")
+    p.add_argument("--steps", type=int, default=100_000, help="Instructions per computer")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Thread pool sizes to try")
+    args = p.parse_args()
+
+    benchmark(args.jobs, args.steps, args.workers)
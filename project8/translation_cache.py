@@ -0,0 +1,77 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+
+# Modules whose code decides what a .vm file translates to
+TRANSLATOR_SOURCES = ("VMTranslator.py", "vm_ir.py", "vm_passes.py")
+
+
+@functools.cache
+def translator_version() -> str:
+    """
+    Hash of the translator's own source, so that changing the
+    translator invalidates everything it cached before.
+    """
+    digest = hashlib.sha256()
+    for name in TRANSLATOR_SOURCES:
+        digest.update((Path(__file__).parent / name).read_bytes())
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    """
+    Translated .vm files on disk, one file per chunk of assembly, keyed
+    by a hash of the VM source, its namespace, the translator options
+    and translator_version.
+
+    Chunks have to come out the same whatever else is in the program,
+    so only translate with file_labels into the cache.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(program: str, namespace: str, options: Dict[str, bool], strip: bool) -> str:
+        digest = hashlib.sha256()
+        header = json.dumps([translator_version(), namespace, options, strip], sort_keys=True)
+        digest.update(header.encode())
+        digest.update(b"\0")
+        digest.update(program.encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}.asm"
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            chunk = self.path(key).read_text()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return chunk
+
+    def put(self, key: str, chunk: str):
+        """
+        Write through a temporary file and rename, so a chunk is never
+        seen half written, even with several builds at once.
+        """
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                fh.write(chunk)
+            os.replace(tmp_name, self.path(key))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def report(self) -> str:
+        return f"cache: {self.hits} hits, {self.misses} translated"
@@ -0,0 +1,185 @@
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+def parsing_error(line_number: int, line: str):
+    raise ValueError((f"No idea how to parse this shit:\n" f"{line_number}: {line}"))
+
+
+ARITHMETIC_OPS = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not")
+
+# Generated by passes: pop y, pop x, and jump to the label if x <cond> y
+COMPARE_GOTO_OPS = ("if-eq", "if-ne", "if-gt", "if-ge", "if-lt", "if-le")
+
+# Number of arguments each command takes
+ARITY: Dict[str, int] = {
+    **{op: 0 for op in ARITHMETIC_OPS},
+    "push": 2,
+    "pop": 2,
+    "label": 1,
+    "goto": 1,
+    "if-goto": 1,
+    "function": 2,
+    "call": 2,
+    "return": 0,
+    # Generated by passes: move <segment> <index> <segment> <index>
+    "move": 4,
+    **{op: 1 for op in COMPARE_GOTO_OPS},
+    # Generated by passes: call and return without a frame
+    "call-leaf": 2,
+    "function-leaf": 1,
+    "return-leaf": 0,
+}
+
+
+class VMCommand:
+    """
+    One VM command.
+
+    Attributes:
+        op: "push", "add", "call", ...
+        arg1: segment, label or function name, if the command has one
+        arg2: index, number of locals or number of arguments, if any
+        namespace: basename of the .vm file the command came from;
+            statics and labels live in it
+        line_number: line in that file, or -1 for generated commands
+        arg3, arg4: destination segment and index of a move
+    """
+
+    __slots__ = ("op", "arg1", "arg2", "namespace", "line_number", "arg3", "arg4")
+
+    def __init__(
+        self,
+        op: str,
+        arg1: Optional[str] = None,
+        arg2: Optional[int] = None,
+        namespace: str = "default",
+        line_number: int = -1,
+        arg3: Optional[str] = None,
+        arg4: Optional[int] = None,
+    ):
+        self.op = op
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.namespace = namespace
+        self.line_number = line_number
+        self.arg3 = arg3
+        self.arg4 = arg4
+
+    def __str__(self) -> str:
+        """
+        The command as VM code, e.g. "push constant 7".
+        """
+        tokens = (self.op, self.arg1, self.arg2, self.arg3, self.arg4)
+        return " ".join(str(token) for token in tokens if token is not None)
+
+    def __repr__(self) -> str:
+        args = f"{self.op!r}, {self.arg1!r}, {self.arg2!r}"
+        if self.arg3 is not None:
+            args += f", arg3={self.arg3!r}, arg4={self.arg4!r}"
+        return f"VMCommand({args}, namespace={self.namespace!r})"
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, VMCommand):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def _key(self) -> tuple:
+        return (self.op, self.arg1, self.arg2, self.arg3, self.arg4, self.namespace)
+
+    __hash__ = None  # type: ignore
+
+    def replace(self, **changes) -> "VMCommand":
+        """
+        Copy of this command with some attributes changed.
+        """
+        attrs = {name: getattr(self, name) for name in self.__slots__}
+        attrs.update(changes)
+        return VMCommand(**attrs)
+
+
+def parse_vm(program: str, namespace: str = "default") -> List[VMCommand]:
+    """
+    Parse VM code into a list of commands.
+
+    Args:
+        program: VM code
+        namespace: should be the basename of the program file, e.g. MyProgram
+    """
+    commands = []
+
+    for line_number, line in enumerate(program.splitlines()):
+        # Discard comment if any
+        idx_comment = line.find("//")
+        if idx_comment != -1:
+            line = line[:idx_comment]
+
+        # Split into tokens. Expect one to three.
+        tokens = line.split()
+        if not tokens:
+            continue
+
+        op = tokens[0]
+        arity = ARITY.get(op)
+        if arity is None or len(tokens) < arity + 1:
+            parsing_error(line_number, line.strip())
+
+        arg1 = tokens[1] if arity >= 1 else None
+        arg2 = arg3 = arg4 = None
+        try:
+            if arity >= 2:
+                arg2 = int(tokens[2])
+            if arity == 4:
+                arg3 = tokens[3]
+                arg4 = int(tokens[4])
+        except ValueError:
+            parsing_error(line_number, line.strip())
+
+        commands.append(VMCommand(op, arg1, arg2, namespace, line_number, arg3, arg4))
+
+    return commands
+
+
+Pass = Callable[[List[VMCommand]], List[VMCommand]]
+
+
+class PassManager:
+    """
+    Ordered list of passes over VM commands.
+
+    A pass takes the commands and returns the new commands; an analysis
+    pass can return its input unchanged. Time spent in each pass is
+    added up in timings, over every run.
+    """
+
+    def __init__(self):
+        self.passes: List[Tuple[str, Pass]] = []
+        self.timings: Dict[str, float] = {}
+
+    def register(self, name: str, func: Pass, before: Optional[str] = None):
+        """
+        Add a pass at the end, or just before the pass called before.
+        """
+        assert name not in self.names(), f"pass {name} is already registered"
+
+        if before is None:
+            self.passes.append((name, func))
+        else:
+            self.passes.insert(self.names().index(before), (name, func))
+        self.timings[name] = 0.0
+
+    def get(self, name: str) -> Pass:
+        return dict(self.passes)[name]
+
+    def names(self) -> List[str]:
+        return [name for name, func in self.passes]
+
+    def run(self, commands: List[VMCommand]) -> List[VMCommand]:
+        for name, func in self.passes:
+            start = time.perf_counter()
+            commands = func(commands)
+            self.timings[name] += time.perf_counter() - start
+        return commands
+
+    def report(self) -> str:
+        return "\n".join(f"{name:<24} {1000*self.timings[name]:9.3f} ms" for name in self.names())
@@ -0,0 +1,568 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from vm_ir import COMPARE_GOTO_OPS, PassManager, VMCommand
+
+# Optimization passes over VM commands. Each one keeps every memory
+# location a VM program can observe (segments, statics, pointers, temp
+# and the stack below SP) exactly as the unoptimized program would.
+#
+# Passes only look within basic blocks: anything that can be jumped to
+# or that hands control elsewhere ends the block.
+BLOCK_ENDS = (
+    ("label", "goto", "if-goto", "function", "call", "return")
+    + COMPARE_GOTO_OPS
+    + ("call-leaf", "function-leaf", "return-leaf")
+)
+
+CALL_OPS = ("call", "call-leaf")
+FUNCTION_OPS = ("function", "function-leaf")
+
+# Segments addressed through a base pointer. They can point anywhere in
+# RAM, so a write through one of them may change any location, and a
+# read may see any location.
+INDIRECT_SEGMENTS = ("local", "argument", "this", "that")
+
+Location = Tuple[str, int]
+
+
+def _reads(command: VMCommand) -> Optional[Location]:
+    """
+    The segment location a push or move reads, if any.
+    """
+    if command.op in ("push", "move") and command.arg1 != "constant":
+        return (command.arg1, command.arg2)
+    return None
+
+
+def _writes(command: VMCommand) -> Optional[Location]:
+    """
+    The segment location a pop or move writes, if any.
+    """
+    if command.op == "pop":
+        return (command.arg1, command.arg2)
+    if command.op == "move":
+        return (command.arg3, command.arg4)
+    return None
+
+
+def fuse_push_pop(commands: List[VMCommand]) -> List[VMCommand]:
+    """
+    push segment i; pop segment' j  =>  move segment i segment' j
+
+    The value goes through D instead of the stack. Its old stack slot is
+    above SP afterwards either way, so nothing can tell the difference.
+    A move has one namespace, so statics from two different files can't
+    be fused.
+    """
+    out: List[VMCommand] = []
+
+    for command in commands:
+        prev = out[-1] if out else None
+        if (
+            command.op == "pop"
+            and prev is not None
+            and prev.op == "push"
+            and (prev.namespace == command.namespace or "static" not in (prev.arg1, command.arg1))
+        ):
+            namespace = prev.namespace if prev.arg1 == "static" else command.namespace
+            out[-1] = prev.replace(op="move", arg3=command.arg1, arg4=command.arg2, namespace=namespace)
+        else:
+            out.append(command)
+
+    return out
+
+
+def propagate_copies(commands: List[VMCommand]) -> List[VMCommand]:
+    """
+    After "move X temp i", read X instead of temp i for as long as both
+    are known to hold the same value. The Jack compiler stores the value
+    of every array assignment in temp 0 and reads it straight back.
+
+    Only constants and directly addressed locations (static, temp,
+    pointer) are forwarded; writes through local/argument/this/that
+    might alias them, so those forget everything.
+    """
+    out: List[VMCommand] = []
+    copies: Dict[Location, VMCommand] = {}  # temp location => move that set it
+
+    for command in commands:
+        if command.op in BLOCK_ENDS:
+            copies.clear()
+            out.append(command)
+            continue
+
+        source = _reads(command)
+        if source is not None and source[0] == "temp" and source in copies:
+            origin = copies[source]
+            command = command.replace(arg1=origin.arg1, arg2=origin.arg2)
+
+        written = _writes(command)
+        if written is not None:
+            if written[0] in INDIRECT_SEGMENTS:
+                copies.clear()
+            else:
+                copies = {
+                    temp: origin for temp, origin in copies.items()
+                    if temp != written and _reads(origin) != written
+                }
+                if (
+                    command.op == "move"
+                    and written[0] == "temp"
+                    and command.arg1 not in INDIRECT_SEGMENTS
+                    and (command.arg1, command.arg2) != written
+                ):
+                    copies[written] = command
+
+        out.append(command)
+
+    return out
+
+
+def remove_dead_stores(commands: List[VMCommand]) -> List[VMCommand]:
+    """
+    Drop "move X temp i" when the same block writes temp i again before
+    anything reads it, e.g. a leftover "push constant 0; pop temp 0".
+    Pops into temp still have to take their value off the stack, so they
+    are left alone.
+    """
+    dead = set()
+    overwritten: set = set()  # temp locations written later in the block, unread in between
+
+    for idx in range(len(commands) - 1, -1, -1):
+        command = commands[idx]
+        if command.op in BLOCK_ENDS:
+            overwritten = set()
+            continue
+
+        written = _writes(command)
+        if written is not None and written[0] == "temp":
+            if command.op == "move" and written in overwritten:
+                dead.add(idx)
+                continue
+            overwritten.add(written)
+
+        source = _reads(command)
+        if source is not None:
+            if source[0] in INDIRECT_SEGMENTS:
+                overwritten = set()
+            else:
+                overwritten.discard(source)
+
+    return [command for idx, command in enumerate(commands) if idx not in dead]
+
+
+# cmp, or cmp followed by not => op that jumps when that is true
+FUSED_COMPARISONS = {
+    ("eq", False): "if-eq",
+    ("gt", False): "if-gt",
+    ("lt", False): "if-lt",
+    ("eq", True): "if-ne",
+    ("gt", True): "if-le",
+    ("lt", True): "if-ge",
+}
+
+
+def fuse_compare_branch(commands: List[VMCommand]) -> List[VMCommand]:
+    """
+    lt|gt|eq [not] if-goto L  =>  if-<cond> L
+
+    The Jack compiler writes "<cond>; not; if-goto" for every if and
+    while, so the boolean is never needed on the stack.
+    """
+    out: List[VMCommand] = []
+
+    for command in commands:
+        if command.op == "if-goto":
+            negated = len(out) >= 2 and out[-1].op == "not"
+            cmp = out[-2] if negated else (out[-1] if out else None)
+            fused = FUSED_COMPARISONS.get((cmp.op, negated)) if cmp is not None else None
+            if fused is not None:
+                del out[-2 if negated else -1:]
+                out.append(command.replace(op=fused))
+                continue
+        out.append(command)
+
+    return out
+
+
+JUMP_OPS = ("goto", "if-goto") + COMPARE_GOTO_OPS
+
+# (namespace, label name)
+LabelKey = Tuple[str, str]
+
+
+def _label_targets(commands: List[VMCommand]) -> Dict[LabelKey, str]:
+    """
+    For each label, where a jump to it may as well go: the first label
+    of its run of adjacent labels, or wherever the goto right after the
+    run jumps to. Keyed by (namespace, label).
+    """
+    targets: Dict[LabelKey, str] = {}
+
+    idx = 0
+    while idx < len(commands):
+        first = commands[idx]
+        if first.op != "label":
+            idx += 1
+            continue
+
+        end = idx
+        while end < len(commands) and commands[end].op == "label" and commands[end].namespace == first.namespace:
+            end += 1
+
+        following = commands[end] if end < len(commands) else None
+        if following is not None and following.op == "goto" and following.namespace == first.namespace:
+            target = following.arg1
+        else:
+            target = first.arg1
+
+        for command in commands[idx:end]:
+            targets[(command.namespace, command.arg1)] = target
+        idx = end
+
+    return targets
+
+
+def _falls_into(commands: List[VMCommand], idx: int, goto: VMCommand) -> bool:
+    """
+    True if the labels starting at commands[idx] include the target of goto.
+    """
+    while idx < len(commands) and commands[idx].op == "label":
+        if commands[idx].namespace == goto.namespace and commands[idx].arg1 == goto.arg1:
+            return True
+        idx += 1
+    return False
+
+
+def thread_jumps(commands: List[VMCommand]) -> List[VMCommand]:
+    """
+    Tidy up the jumps that the Jack compiler's if/else layout leaves:
+
+        label A; label B    jumps to B go to A
+        label A; goto B     jumps to A go straight to B, or further
+        goto A; label A     the goto goes
+        label A             goes if nothing jumps to it
+
+    Labels belong to their file, so only labels and jumps from the same
+    file are combined. Repeats until nothing changes, since each rule
+    can make work for the others.
+    """
+    while True:
+        targets = _label_targets(commands)
+
+        def resolve(namespace: str, label: str) -> str:
+            seen = set()
+            while label not in seen and targets.get((namespace, label), label) != label:
+                seen.add(label)
+                label = targets[(namespace, label)]
+            return label
+
+        threaded: List[VMCommand] = []
+        for command in commands:
+            if command.op in JUMP_OPS:
+                target = resolve(command.namespace, command.arg1)
+                if target != command.arg1:
+                    command = command.replace(arg1=target)
+            threaded.append(command)
+
+        threaded = [
+            command for idx, command in enumerate(threaded)
+            if command.op != "goto" or not _falls_into(threaded, idx + 1, command)
+        ]
+
+        referenced = {(command.namespace, command.arg1) for command in threaded if command.op in JUMP_OPS}
+        threaded = [
+            command for command in threaded
+            if command.op != "label" or (command.namespace, command.arg1) in referenced
+        ]
+
+        if threaded == commands:
+            return threaded
+        commands = threaded
+
+
+def function_blocks(commands: List[VMCommand]) -> List[Tuple[Optional[str], List[VMCommand]]]:
+    """
+    Split commands at each "function". Commands before the first
+    function come back under the name None.
+    """
+    blocks: List[Tuple[Optional[str], List[VMCommand]]] = []
+
+    for command in commands:
+        if command.op in FUNCTION_OPS:
+            blocks.append((command.arg1, []))
+        elif not blocks or command.namespace != blocks[-1][1][-1].namespace:
+            # Top level code at the start of a file
+            blocks.append((None, []))
+        blocks[-1][1].append(command)
+
+    return blocks
+
+
+class DeadFunctionElimination:
+    """
+    Whole-program pass that drops every function no chain of calls
+    reaches from the roots or from top level code. Run it on all files
+    at once: a function only called from another file looks dead on
+    its own.
+
+    After a run, removed maps each dropped function to its commands.
+    """
+
+    def __init__(self, roots: Sequence[str] = ("Sys.init",)):
+        self.roots = tuple(roots)
+        self.removed: Dict[str, List[VMCommand]] = {}
+
+    def __call__(self, commands: List[VMCommand]) -> List[VMCommand]:
+        blocks = function_blocks(commands)
+
+        callees: Dict[str, List[str]] = {}
+        to_visit = list(self.roots)
+        for name, block in blocks:
+            calls = [command.arg1 for command in block if command.op in CALL_OPS]
+            if name is None:
+                to_visit.extend(calls)
+            else:
+                callees.setdefault(name, []).extend(calls)
+
+        reachable = set()
+        while to_visit:
+            name = to_visit.pop()
+            if name in reachable or name not in callees:
+                continue
+            reachable.add(name)
+            to_visit.extend(callees[name])
+
+        out: List[VMCommand] = []
+        self.removed = {}
+        for name, block in blocks:
+            if name is None or name in reachable:
+                out.extend(block)
+            else:
+                self.removed.setdefault(name, []).extend(block)
+
+        return out
+
+
+# Change in stack depth for each command that doesn't jump
+STACK_EFFECT = {
+    **{op: -1 for op in ("add", "sub", "and", "or", "eq", "gt", "lt")},
+    "neg": 0, "not": 0,
+    "push": 1, "pop": -1, "move": 0,
+    "label": 0, "function": 0,
+}
+
+NUM_TEMP = 8
+
+
+def _temps_used(commands: List[VMCommand]) -> set:
+    used = set()
+    for command in commands:
+        for location in (_reads(command), _writes(command)):
+            if location is not None and location[0] == "temp":
+                used.add(location[1])
+    return used
+
+
+def _balanced(body: List[VMCommand]) -> bool:
+    """
+    True if the stack is empty at every label and jump and holds just
+    the return value at every return, which is how the Jack compiler
+    writes functions. Only then can an inlined body leave exactly one
+    value where the call would have.
+    """
+    depth = 0
+    for command in body:
+        op = command.op
+        if op == "return":
+            if depth != 1:
+                return False
+            depth = 0
+        elif op == "goto" or op == "label":
+            if depth != 0:
+                return False
+        elif op == "if-goto" or op in COMPARE_GOTO_OPS:
+            depth -= 1 if op == "if-goto" else 2
+            if depth != 0:
+                return False
+        elif op in STACK_EFFECT:
+            depth += STACK_EFFECT[op]
+            if depth < 0:
+                return False
+        else:
+            return False
+    return bool(body) and body[-1].op in ("return", "goto")
+
+
+class Inliner:
+    """
+    Whole-program pass that replaces calls to small leaf functions with
+    their bodies. Arguments and locals live in temp slots that neither
+    the caller nor the callee uses; THIS/THAT are saved in temp slots
+    too if the callee sets them. Labels get a suffix per call site, and
+    each return becomes a jump to the end of the inlined code.
+
+    A function is inlined if it makes no calls, keeps the stack balanced
+    (see _balanced), and either has at most max_size commands or is in
+    allow. Call sites without enough free temp slots keep the call.
+
+    After a run, inlined counts the call sites replaced per function.
+    """
+
+    def __init__(self, max_size: int = 12, allow: Sequence[str] = ()):
+        self.max_size = max_size
+        self.allow = set(allow)
+        self.inlined: Dict[str, int] = {}
+        self.num_sites = 0
+
+    def inlinable(self, name: str, body: List[VMCommand]) -> bool:
+        if name not in self.allow and len(body) > self.max_size:
+            return False
+        if any(command.op in CALL_OPS for command in body):
+            return False
+        return _balanced(body)
+
+    def __call__(self, commands: List[VMCommand]) -> List[VMCommand]:
+        blocks = function_blocks(commands)
+
+        callees: Dict[str, Tuple[VMCommand, List[VMCommand]]] = {}
+        for name, block in blocks:
+            if name is not None and self.inlinable(name, block[1:]):
+                callees[name] = (block[0], block[1:])
+
+        self.inlined = {}
+        out: List[VMCommand] = []
+        for name, block in blocks:
+            caller_temps = _temps_used(block)
+            for command in block:
+                if command.op == "call" and command.arg1 in callees and command.arg1 != name:
+                    expansion = self.expand(command, *callees[command.arg1], caller_temps)
+                    if expansion is not None:
+                        out.extend(expansion)
+                        self.inlined[command.arg1] = self.inlined.get(command.arg1, 0) + 1
+                        continue
+                out.append(command)
+
+        return out
+
+    def expand(
+        self, call: VMCommand, function: VMCommand, body: List[VMCommand], caller_temps: set
+    ) -> Optional[List[VMCommand]]:
+        """
+        The commands that replace call, or None if they don't fit.
+        """
+        num_args, num_locals = call.arg2, function.arg2
+        pointers = sorted({command.arg2 for command in body if _writes(command) in (("pointer", 0), ("pointer", 1))})
+
+        free = [ii for ii in range(NUM_TEMP) if ii not in caller_temps | _temps_used(body)]
+        if len(free) < num_args + num_locals + len(pointers):
+            return None
+        args, free = free[:num_args], free[num_args:]
+        locals_, free = free[:num_locals], free[num_locals:]
+        saved = dict(zip(pointers, free))
+
+        segments = {"argument": args, "local": locals_}
+        for command in body:
+            for location in (_reads(command), _writes(command)):
+                if location is not None and location[0] in segments and location[1] >= len(segments[location[0]]):
+                    return None
+
+        self.num_sites += 1
+        suffix = f"$inline.{self.num_sites}"
+        end_label = f"{function.arg1.split('.')[-1]}{suffix}.END"
+        generated = dict(namespace=call.namespace, line_number=call.line_number)
+
+        def remap(segment, index):
+            if segment in segments:
+                return "temp", segments[segment][index]
+            return segment, index
+
+        out = [VMCommand("pop", "temp", args[ii], **generated) for ii in reversed(range(num_args))]
+        out += [VMCommand("move", "pointer", pp, arg3="temp", arg4=saved[pp], **generated) for pp in pointers]
+        out += [VMCommand("move", "constant", 0, arg3="temp", arg4=slot, **generated) for slot in locals_]
+        restore = [VMCommand("move", "temp", saved[pp], arg3="pointer", arg4=pp, **generated) for pp in pointers]
+
+        for command in body:
+            if command.op in ("push", "pop", "move"):
+                segment, index = remap(command.arg1, command.arg2)
+                command = command.replace(arg1=segment, arg2=index)
+                if command.op == "move":
+                    segment, index = remap(command.arg3, command.arg4)
+                    command = command.replace(arg3=segment, arg4=index)
+                out.append(command)
+            elif command.op in ("label", "goto", "if-goto") or command.op in COMPARE_GOTO_OPS:
+                out.append(command.replace(arg1=command.arg1 + suffix))
+            elif command.op == "return":
+                out += restore
+                out.append(VMCommand("goto", end_label, **generated))
+            else:
+                out.append(command)
+
+        if out[-1].op == "goto" and out[-1].arg1 == end_label:
+            out.pop()
+        out.append(VMCommand("label", end_label, **generated))
+        return out
+
+
+class FrameElision:
+    """
+    Whole-program pass that gives leaf functions a call and return
+    without a frame. A function qualifies if it has no locals, makes no
+    calls, never uses the argument or local segments, never sets
+    THIS/THAT, and keeps the stack balanced (see _balanced). Its body
+    then runs just as well on the caller's LCL, ARG, THIS and THAT, so
+    there is nothing to save or restore:
+
+        call f n      =>  call-leaf f n      return address in R14
+        function f 0  =>  function-leaf f
+        return        =>  return-leaf        jump back through R14
+
+    Every call site has to be rewritten, so run it on all files at once.
+    After a run, elided lists the functions that lost their frame.
+    """
+
+    def __init__(self):
+        self.elided: List[str] = []
+
+    @staticmethod
+    def frameless(function: VMCommand, body: List[VMCommand]) -> bool:
+        if function.op != "function" or function.arg2 != 0:
+            return False
+        for command in body:
+            if command.op in CALL_OPS:
+                return False
+            read, written = _reads(command), _writes(command)
+            if any(location is not None and location[0] in ("local", "argument") for location in (read, written)):
+                return False
+            if written is not None and written[0] == "pointer":
+                return False
+        return _balanced(body)
+
+    def __call__(self, commands: List[VMCommand]) -> List[VMCommand]:
+        blocks = function_blocks(commands)
+        self.elided = [name for name, block in blocks if name is not None and self.frameless(block[0], block[1:])]
+        leaves = set(self.elided)
+
+        out: List[VMCommand] = []
+        for name, block in blocks:
+            for command in block:
+                if command.op == "call" and command.arg1 in leaves:
+                    command = command.replace(op="call-leaf")
+                elif name in leaves and command.op == "function":
+                    command = command.replace(op="function-leaf", arg2=None)
+                elif name in leaves and command.op == "return":
+                    command = command.replace(op="return-leaf")
+                out.append(command)
+
+        return out
+
+
+def register_optimizations(passes: PassManager):
+    """
+    Add the standard optimization passes, in order.
+    """
+    passes.register("thread_jumps", thread_jumps)
+    passes.register("fuse_push_pop", fuse_push_pop)
+    passes.register("propagate_copies", propagate_copies)
+    passes.register("remove_dead_stores", remove_dead_stores)
+    passes.register("fuse_compare_branch", fuse_compare_branch)